@@ -1,6 +1,7 @@
 from pydqt.pydqt import (
     get_global_template_dir,
     create_test_data,
+    generate_data,
     test_data_exists,
     test_data_file_full_path,
     set_workspace,
@@ -10,6 +11,12 @@ from pydqt.pydqt import (
     get_schema,
     get_database,
     get_warehouse,
+    set_cache_format,
+    get_cache_format,
+    set_cache_policy,
+    get_cache_policy,
+    set_memory_cache,
+    set_csv_ingest,
     get_db_settings,
     set_snowflake_credentials,
     env_file_full_path,
@@ -19,11 +26,23 @@ from pydqt.pydqt import (
     get_user_template_dir,
     get_user_macros_dir,
     get_user_includes_dir,
+    clear_template_cache,
     py_connect_db,
+    get_duckdb,
+    get_connection,
+    close_all,
     QueryTemplateParams,
     QueryParams,
     Query,
     Test,
+    TestSuite,
+    DataTestSuite,
+    QueryBatch,
+    run_many,
+    split_grouping_sets,
+    add_profile_hook,
+    remove_profile_hook,
+    get_query_stats,
     Sql,
     Workspace,
 )
@@ -34,6 +53,7 @@ from pydqt.pydqt import (
 __all__ = [
     "get_global_template_dir",
     "create_test_data",
+    "generate_data",
     "test_data_exists",    
     "test_data_file_full_path",
     "set_workspace",
@@ -48,15 +68,33 @@ __all__ = [
     "get_schema",
     "get_database",
     "get_warehouse",
+    "set_cache_format",
+    "get_cache_format",
+    "set_cache_policy",
+    "get_cache_policy",
+    "set_memory_cache",
+    "set_csv_ingest",
     "get_db_settings",
     "get_user_template_dir",
     "get_user_macros_dir",
     "get_user_includes_dir",
+    "clear_template_cache",
     "py_connect_db",
+    "get_duckdb",
+    "get_connection",
+    "close_all",
     "QueryTemplateParams",
     "QueryParams",
     "Query",
     "Test",
+    "TestSuite",
+    "DataTestSuite",
+    "QueryBatch",
+    "run_many",
+    "split_grouping_sets",
+    "add_profile_hook",
+    "remove_profile_hook",
+    "get_query_stats",
     "Sql",
     "Workspace",
     "pydqt"
@@ -0,0 +1,259 @@
+"""
+Benchmarks of pydqt's hot paths, runnable offline (everything runs on the local duckdb engine):
+
+    python -m pydqt.benchmarks run --sizes 10000,1000000 --out before.json
+    python -m pydqt.benchmarks run --sizes 10000,1000000 --out after.json
+    python -m pydqt.benchmarks compare before.json after.json
+
+Data is generated by pydqt.synthetic.generate_data (seeded, so every run times the same data).  Benchmarks run in a
+temporary workspace, so your own workspace and cache are untouched.  Results are saved as json
+(with the pydqt version, git commit, python version and platform) so that runs on two commits can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import duckdb
+
+from . import pydqt as dqt
+from .datatests import DataTestSuite
+from .synthetic import generate_data
+
+
+DEFAULT_SIZES = [10_000, 1_000_000]
+MAX_SIZE = 50_000_000
+
+TEMPLATE = """
+select
+    dates,
+    region,
+    source,
+    orders,
+    gmv
+from '{{ table }}'
+where dates >= '{{ min_date }}'
+"""
+
+MACRO_TEMPLATE = """
+{% import 'macros.jinja' as macros %}
+with daily as (
+    select
+        dates,
+        {{ macros.grouping_id(dims) }},
+        {{ dims | join(', ') }},
+        sum(gmv) as gmv
+    from '{{ table }}'
+    where dates >= '{{ min_date }}'
+    {{ macros.grouping_sets(['dates'] + dims) }}
+)
+select *, {{ macros.ma('gmv', n, order='dates', partition='grouping_id') }} as ma_gmv
+from daily
+"""
+
+AGGREGATION_TEMPLATE = """
+select region, source, date_trunc('month', dates) as month, sum(orders) as orders, sum(gmv) as gmv
+from read_parquet('{{ table }}')
+group by 1, 2, 3
+"""
+
+DATA_TESTS = [
+    {"name": "orders_are_non_negative", "assert": "'orders'>=0"},
+    {"name": "gmv_is_non_negative", "assert": "'gmv'>=0"},
+    {"name": "gmv_per_order", "assert": "('gmv'/'orders').fillna(0)<=100"},
+    {"name": "known_sources", "assert": "'source'.isin([`css`,`direct`,`organic`,`app`])"},
+    {"name": "orders_sum_positive", "assert": "'orders'.sum()>0"},
+]
+
+
+@contextmanager
+def temporary_workspace():
+    """
+    points pydqt at a throwaway workspace for the duration of the block (without touching the .env file)
+    """
+    dqt.ensure_setup()
+    root = tempfile.mkdtemp(prefix='pydqt_bench_')
+    saved = {k: os.environ.get(k) for k in ['WORKSPACE_ROOT', 'WORKSPACE_NAME']}
+    os.environ['WORKSPACE_ROOT'] = root
+    os.environ['WORKSPACE_NAME'] = 'bench'
+    dqt.clear_template_cache()
+    dqt.setup_local_dirs()
+    try:
+        yield os.path.join(root, 'bench')
+    finally:
+        dqt.close_duckdb()
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        dqt.clear_template_cache()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def timeit(func, repeat=3):
+    """
+    returns the timings (in seconds) of repeat calls of func
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _write_template(name, text):
+    with open(os.path.join(dqt.get_user_template_dir(), name), 'w') as f:
+        f.write(text)
+
+
+def run_benchmarks(sizes=None, repeat=3, seed=42, only=None):
+    """
+    runs the benchmark suite over synthetic datasets of each size (number of rows) and returns the results as a dict;
+    only (a list of benchmark names) restricts which benchmarks are run
+    """
+    sizes = sizes or DEFAULT_SIZES
+    assert all(0 < n <= MAX_SIZE for n in sizes), f"sizes must be between 1 and {MAX_SIZE} rows"
+    results = []
+
+    def record(name, rows, timings, **extra):
+        if only and name not in only:
+            return
+        results.append(dict({
+            'name': name,
+            'rows': rows,
+            'repeat': len(timings),
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+        }, **extra))
+
+    def wanted(name):
+        return not only or name in only
+
+    with temporary_workspace() as workspace:
+        _write_template('bench.sql', TEMPLATE)
+        _write_template('bench_macros.sql', MACRO_TEMPLATE)
+        _write_template('bench_agg.sql', AGGREGATION_TEMPLATE)
+        table = os.path.join(workspace, 'bench.csv')
+
+        # size independent: compiling and constructing queries
+        if wanted('query_construction'):
+            n = 1000
+            timings = timeit(lambda: [dqt.Query('bench.sql', table=table, min_date='2022-06-01') for _ in range(n)], repeat)
+            record('query_construction', None, [t/n for t in timings], calls=n)
+        if wanted('render_macros'):
+            n = 200
+            def render():
+                dqt.clear_template_cache()
+                for i in range(n):
+                    dqt.compile('bench_macros.sql', table=table, min_date=f'2022-06-{1 + i % 28:02d}', dims=['region', 'source'], n=1 + i)
+            record('render_macros', None, [t/n for t in timeit(render, repeat)], calls=n)
+
+        for rows in sizes:
+            data_file = generate_data(rows, os.path.join(workspace, f'bench_{rows}.parquet'), periods=730, seed=seed)
+            df = dqt.read_cache_data(data_file)
+            for fmt in dqt.CACHE_FORMATS:
+                dir_loc = os.path.join(workspace, f'cache_{fmt}_{rows}')
+                os.makedirs(dir_loc, exist_ok=True)
+                if wanted(f'cache_write_{fmt}'):
+                    record(f'cache_write_{fmt}', rows, timeit(lambda: dqt.write_cache_data(df, dir_loc, fmt=fmt), repeat))
+                cached_file = dqt.write_cache_data(df, dir_loc, fmt=fmt)
+                if wanted(f'cache_read_{fmt}'):
+                    record(f'cache_read_{fmt}', rows, timeit(lambda: dqt.read_cache_data(cached_file), repeat),
+                           bytes=os.path.getsize(cached_file))
+            if wanted('data_tests'):
+                suite = DataTestSuite(DATA_TESTS)
+                record('data_tests', rows, timeit(lambda: suite.run(df, verbose=False), repeat), tests=len(DATA_TESTS))
+            if wanted('local_aggregation'):
+                record('local_aggregation', rows, timeit(lambda: dqt.Query('bench_agg.sql', engine='duckdb', cache=False, table=data_file).run(), repeat))
+            del df
+
+    return {'meta': environment_info(repeat=repeat, seed=seed, sizes=sizes), 'results': results}
+
+
+def environment_info(**kwargs):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        from importlib.metadata import version
+        pydqt_version = version('pydqt')
+    except Exception:
+        pydqt_version = None
+    return dict({
+        'pydqt': pydqt_version,
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'duckdb': duckdb.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }, **kwargs)
+
+
+def compare(before, after):
+    """
+    compares two benchmark results (dicts or json file names), returning a list of
+    {'name', 'rows', 'before', 'after', 'ratio'} (median seconds; ratio > 1 means after is slower)
+    """
+    if isinstance(before, str):
+        with open(before) as f:
+            before = json.load(f)
+    if isinstance(after, str):
+        with open(after) as f:
+            after = json.load(f)
+    medians = {(r['name'], r['rows']): r['median'] for r in before['results']}
+    rows = []
+    for r in after['results']:
+        key = (r['name'], r['rows'])
+        if key in medians:
+            rows.append({'name': r['name'], 'rows': r['rows'], 'before': medians[key], 'after': r['median'],
+                         'ratio': r['median']/medians[key] if medians[key] else None})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pydqt.benchmarks', description='pydqt benchmark suite')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument('--sizes', default=','.join(str(n) for n in DEFAULT_SIZES), help='comma separated row counts')
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--seed', type=int, default=42)
+    run.add_argument('--only', default='', help='comma separated benchmark names')
+    run.add_argument('--out', default='', help='json file to write results to')
+    cmp = commands.add_parser('compare', help='compare two json result files')
+    cmp.add_argument('before')
+    cmp.add_argument('after')
+    args = parser.parse_args(argv)
+
+    if args.command=='run':
+        results = run_benchmarks(
+            sizes=[int(n) for n in args.sizes.split(',')],
+            repeat=args.repeat,
+            seed=args.seed,
+            only=[n for n in args.only.split(',') if n] or None,
+        )
+        for r in results['results']:
+            print(f"{r['name']:<24} {str(r['rows'] or ''):>10} {r['median']:.6f}s")
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+    else:
+        for r in compare(args.before, args.after):
+            print(f"{r['name']:<24} {str(r['rows'] or ''):>10} {r['before']:.6f}s -> {r['after']:.6f}s  x{r['ratio']:.2f}")
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import ast
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+
+_COLUMN = re.compile(r"'(.*?)'")
+
+
+def _eq(lhs, rhs):
+    # pandas has NaN!=NaN, but a test like 'a'=='b' should pass where both sides are missing
+    result = lhs == rhs
+    if isinstance(result, (pd.Series, np.ndarray)):
+        result = result | (pd.isna(lhs) & pd.isna(rhs))
+    return result
+
+
+def _ne(lhs, rhs):
+    return ~_eq(lhs, rhs) if isinstance(lhs, pd.Series) or isinstance(rhs, pd.Series) else lhs != rhs
+
+
+class _NullSafeEquality(ast.NodeTransformer):
+    """
+    rewrites simple a==b and a!=b comparisons as null safe _eq(a, b) and _ne(a, b) calls
+    """
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops)==1 and isinstance(node.ops[0], (ast.Eq, ast.NotEq)):
+            func = '_eq' if isinstance(node.ops[0], ast.Eq) else '_ne'
+            call = ast.Call(func=ast.Name(id=func, ctx=ast.Load()), args=[node.left, node.comparators[0]], keywords=[])
+            return ast.copy_location(call, node)
+        return node
+
+
+class _Columns(dict):
+    """
+    columns of df, looked up once and shared by every assertion in a run
+    """
+    def __init__(self, df):
+        super().__init__()
+        self.df = df
+
+    def __missing__(self, column):
+        series = self.df[column]
+        self[column] = series
+        return series
+
+
+class DataTest:
+    """
+    a single json data test, ie {"name": ..., "assert": ...}, compiled once.
+
+    In the assertion, single-quoted names are dataframe columns and backtick-quoted text is a string, eg:
+
+        "'source'==`css`"
+    """
+    def __init__(self, name, assertion):
+        self.name = name
+        self.assertion = assertion
+        self.columns = list(dict.fromkeys(_COLUMN.findall(assertion)))
+        expression = _COLUMN.sub(lambda m: f'__columns__[{m.group(1)!r}]', assertion).replace('`', "'")
+        tree = ast.fix_missing_locations(_NullSafeEquality().visit(ast.parse(expression, mode='eval')))
+        self.code = compile(tree, f'<test {name}>', 'eval')
+
+    def __repr__(self):
+        return f'DataTest(name={self.name!r}, assert={self.assertion!r})'
+
+    def evaluate(self, columns):
+        """
+        returns a boolean Series (one value per record) or a single boolean
+        """
+        return eval(self.code, {'__columns__': columns, '_eq': _eq, '_ne': _ne, 'np': np, 'pd': pd})
+
+
+class DataTestSuite:
+    """
+    A compiled set of json data tests (see Query.test).
+
+    All assertions are parsed and compiled once, then evaluated together against a dataframe, sharing column
+    lookups.  Record level results are summarised as counts and the index labels of failing records; copies of the
+    failing records are only made if failed_records=True.
+
+        suite = DataTestSuite.from_json('workspace/tests/json/example.json')
+        report = suite.run(df)
+    """
+    def __init__(self, tests):
+        self.tests = [DataTest(test['name'], test['assert']) for test in tests]
+
+    def __repr__(self):
+        return f'DataTestSuite(tests={[test.name for test in self.tests]})'
+
+    def __len__(self):
+        return len(self.tests)
+
+    @classmethod
+    def from_json(cls, json_file):
+        with open(json_file, 'r') as fobj:
+            return cls(json.load(fobj)['tests'])
+
+    def run(self, df, failed_records=False, verbose=True):
+        """
+        runs every test against df and returns a report of {test name: result}, where result is:
+
+         - 'All Passed!' or {'fails': n, 'percentage_fails': pct, 'failed_index': index of failing records}
+           (plus 'failed_records' if failed_records is True) for record level tests
+         - 'Passed' or 'Failed' for tests which return a single boolean
+        """
+        missing = sorted({c for test in self.tests for c in test.columns} - set(df.columns))
+        assert not missing, f"columns {missing} used in tests are not in the data"
+        columns = _Columns(df)
+        report = {}
+        for test in self.tests:
+            tfs = test.evaluate(columns)
+            if isinstance(tfs, (pd.Series, np.ndarray)):
+                failed = np.asarray(tfs==False)
+                fails = int(np.count_nonzero(failed))
+                if fails>0:
+                    result = {
+                        "fails": fails,
+                        "percentage_fails": 100*fails/len(df),
+                        "failed_index": df.index[failed],
+                    }
+                    if failed_records:
+                        result["failed_records"] = df[failed]
+                else:
+                    result = "All Passed!"
+                if verbose:
+                    print(f'Checking {test.name}: {fails} of {len(df)} records failed ({100*fails/max(len(df),1):.2f}%)')
+            elif isinstance(tfs, (bool, np.bool_)):
+                result = "Passed" if tfs else "Failed"
+                if verbose:
+                    print(f'Checking {test.name}: test {result.lower()}')
+            else:
+                raise TypeError(f"test {test.name} returned {type(tfs).__name__}, expected a Series of booleans or a boolean")
+            report[test.name] = result
+        return report
@@ -0,0 +1,157 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class PoolExhaustedException(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections, keyed by connection context
+    (eg (warehouse, database, schema, role) for snowflake).
+
+    Connections are created on demand by the connect callable, up to max_size per key.  Idle connections
+    are closed once unused for longer than max_idle seconds, and any connection idle for longer than
+    ping_after seconds is health checked (with 'select 1') before it is handed out again.
+
+    Use checkout() as a context manager:
+
+        with pool.checkout(key, **connect_kwargs) as conn:
+            ...
+    """
+    def __init__(self, connect, max_size=4, max_idle=600, ping_after=60, timeout=300):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        self._idle = {}     # key -> list of (conn, last_used)
+        self._in_use = {}   # key -> number of checked out connections
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return f'ConnectionPool(max_size={self.max_size}, max_idle={self.max_idle}, stats={self.stats()})'
+
+    def stats(self):
+        """
+        returns {key: {'idle': n, 'in_use': n}} for every key the pool knows about
+        """
+        with self._cond:
+            keys = set(self._idle) | set(self._in_use)
+            return {k: {'idle': len(self._idle.get(k, [])), 'in_use': self._in_use.get(k, 0)} for k in keys}
+
+    def acquire(self, key, **connect_kwargs):
+        """
+        returns a healthy connection for key, reusing an idle one if possible.  Blocks (up to timeout seconds)
+        if max_size connections for key are already checked out.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            stale = []
+            with self._cond:
+                stale += self._evict_idle()
+                idle = self._idle.setdefault(key, [])
+                while not idle and self._in_use.get(key, 0) >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhaustedException(f'no connection available for {key} after {self.timeout}s')
+                    self._cond.wait(remaining)
+                    stale += self._evict_idle()
+                self._in_use[key] = self._in_use.get(key, 0) + 1
+                conn, last_used = idle.pop() if idle else (None, None)
+            for stale_conn in stale:
+                self._close(stale_conn)
+
+            if conn is None:
+                try:
+                    return self.connect(**connect_kwargs)
+                except BaseException:
+                    self._release_slot(key)
+                    raise
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._close(conn)
+            self._release_slot(key)
+
+    def release(self, key, conn, discard=False):
+        """
+        returns conn to the pool (or closes it if discard is True or it has been closed)
+        """
+        if discard or self._is_closed(conn):
+            self._close(conn)
+        else:
+            with self._cond:
+                self._idle.setdefault(key, []).append((conn, time.monotonic()))
+        self._release_slot(key)
+
+    @contextmanager
+    def checkout(self, key, **connect_kwargs):
+        conn = self.acquire(key, **connect_kwargs)
+        try:
+            yield conn
+        except BaseException:
+            self.release(key, conn, discard=self._is_closed(conn))
+            raise
+        else:
+            self.release(key, conn)
+
+    def close_all(self):
+        """
+        closes all idle connections; checked out connections are closed when they are released
+        """
+        with self._cond:
+            idle = [conn for conns in self._idle.values() for conn, _ in conns]
+            self._idle.clear()
+        for conn in idle:
+            self._close(conn)
+
+    def _release_slot(self, key):
+        with self._cond:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            self._cond.notify_all()
+
+    def _evict_idle(self):
+        # must be called with self._cond held; returns the evicted connections for the caller to close
+        now = time.monotonic()
+        stale = []
+        for key, conns in self._idle.items():
+            stale += [conn for conn, last_used in conns if now - last_used > self.max_idle]
+            conns[:] = [(conn, last_used) for conn, last_used in conns if now - last_used <= self.max_idle]
+        return stale
+
+    def _is_healthy(self, conn, last_used):
+        if self._is_closed(conn):
+            return False
+        if time.monotonic() - last_used <= self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+        except Exception:
+            return False
+        try:
+            cur.execute('select 1')
+            return True
+        except Exception:
+            return False
+        finally:
+            try:
+                cur.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_closed(conn):
+        is_closed = getattr(conn, 'is_closed', None)
+        try:
+            return bool(is_closed()) if callable(is_closed) else False
+        except Exception:
+            return True
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
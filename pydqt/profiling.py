@@ -0,0 +1,167 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Profile:
+    """
+    Timings (in seconds) of the stages of a Query's lifecycle, plus row and byte counts; see Query.profile.
+
+    Stages are: compile, format, connect, execute, fetch, convert, cache_read and cache_write (a stage which
+    didn't happen is absent).  'total' is the wall time of the last top level run() or load() call and query_id
+    is the snowflake query id, if the query ran on snowflake.
+    """
+    def __init__(self, template=None):
+        self.template = template
+        self.stages = {}
+        self.rows = None
+        self.bytes = {}
+        self.query_id = None
+        self.call = None
+        self.cache = None
+        self._depth = 0
+
+    def __repr__(self):
+        stages = ', '.join(f'{k}={v:.4f}s' for k, v in self.stages.items())
+        return f'Profile({self.call or "not run"}: {stages}, rows={self.rows}, bytes={self.bytes}, query_id={self.query_id})'
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    @contextmanager
+    def track(self, call):
+        """
+        profiles a run() or load() call; nested calls (eg load() calling run()) are folded into the outer one, which
+        resets the profile (apart from compile, which only happens once), records its latency in STATS and sends the
+        profile to any hooks
+        """
+        outer = self._depth==0
+        if outer:
+            self.stages = {k: v for k, v in self.stages.items() if k in ('compile', 'format')}
+            self.rows, self.bytes, self.query_id, self.cache = None, {}, None, None
+            self.call = call
+            start = time.perf_counter()
+        self._depth += 1
+        error = None
+        try:
+            yield self
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._depth -= 1
+            if outer:
+                self.stages['total'] = time.perf_counter() - start
+                STATS.record(self.template, self.stages['total'], cache=self.cache, error=error is not None)
+                emit(self, error)
+
+    def to_dict(self):
+        return {
+            'template': self.template,
+            'call': self.call,
+            'stages': dict(self.stages),
+            'rows': self.rows,
+            'bytes': dict(self.bytes),
+            'query_id': self.query_id,
+            'cache': self.cache,
+        }
+
+
+class QueryStats:
+    """
+    Process-wide registry of Query latencies and cache hits / misses, per template (ad-hoc sql is recorded under
+    None).  Latency percentiles are over the last max_samples calls of each template.
+    """
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._templates = {}
+
+    def __repr__(self):
+        return f'QueryStats(templates={len(self._templates)})'
+
+    def record(self, template, seconds, cache=None, error=False):
+        with self._lock:
+            stats = self._templates.setdefault(template, {
+                'calls': 0, 'errors': 0, 'cache_hits': 0, 'cache_misses': 0,
+                'latencies': deque(maxlen=self.max_samples),
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            if cache=='hit':
+                stats['cache_hits'] += 1
+            elif cache=='miss':
+                stats['cache_misses'] += 1
+            stats['latencies'].append(seconds)
+
+    def summary(self):
+        """
+        returns {template: {'calls', 'errors', 'cache_hits', 'cache_misses', 'hit_rate', 'p50', 'p95'}}
+        """
+        with self._lock:
+            summary = {}
+            for template, stats in self._templates.items():
+                lookups = stats['cache_hits'] + stats['cache_misses']
+                latencies = np.array(stats['latencies'])
+                summary[template] = {
+                    'calls': stats['calls'],
+                    'errors': stats['errors'],
+                    'cache_hits': stats['cache_hits'],
+                    'cache_misses': stats['cache_misses'],
+                    'hit_rate': stats['cache_hits']/lookups if lookups else None,
+                    'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    'p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                }
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self._templates.clear()
+
+
+STATS = QueryStats()
+_HOOKS = []
+
+
+def add_profile_hook(hook):
+    """
+    registers hook(profile_dict) to be called after every Query run() / load(), eg to export timings to logs or
+    metrics.  profile_dict is Profile.to_dict() plus an 'error' key (None, or the exception raised).  Exceptions
+    raised by hooks are ignored.
+    """
+    if hook not in _HOOKS:
+        _HOOKS.append(hook)
+
+
+def remove_profile_hook(hook):
+    if hook in _HOOKS:
+        _HOOKS.remove(hook)
+
+
+def emit(profile, error=None):
+    if not _HOOKS:
+        return
+    data = dict(profile.to_dict(), error=error)
+    for hook in list(_HOOKS):
+        try:
+            hook(data)
+        except Exception:
+            pass
+
+
+def get_query_stats():
+    """
+    returns the process-wide cache hit rates and p50 / p95 latencies of Query run() / load() calls, per template
+    """
+    return STATS.summary()
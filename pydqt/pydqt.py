@@ -1,23 +1,32 @@
-import math, random
-import sqlparse
-import snowflake.connector
 import pathlib
-import datetime
 import re
 import json
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, meta
 import os
 from dotenv import load_dotenv, find_dotenv
 import pandas as pd
 import numpy as np
 from pprint import pprint
 import uuid
-import duckdb
-from duckdb import CatalogException
+import tempfile
+import hashlib
+import time
 from pathlib import Path
 import shutil
-from snowflake.connector.pandas_tools import write_pandas
+import atexit
+import threading
+import functools
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 from .utils import custom_filters as filters
+from .pool import ConnectionPool
+from .datatests import DataTestSuite
+from .synthetic import generate_data, REGIONS, SOURCES
+from .profiling import Profile, add_profile_hook, remove_profile_hook, get_query_stats
 
 
 class NoDataException(Exception):
@@ -27,6 +36,7 @@ def env_file_full_path():
     return os.path.join(Path(__file__).parents[0],'.env')
 
 def test_data_file_full_path(dups=True):
+    ensure_setup()
     return os.path.join(Path(__file__).parents[0],'test.csv')
 
 def test_data_exists():
@@ -35,38 +45,18 @@ def test_data_exists():
         return True
     return False
 
-def create_test_data():
-    """
-    creates a test.csv data file which we can run tests against and users can practice with
-    """
-    regions = ['US','GB','DE','IT','ES','FR']
-    sources = ['css','direct','organic','app']
-    dates = pd.date_range(start='2022-01-01',periods=21,freq='M')
-
-    cnt=0
-    for region in regions:
-        for source in sources:
-            orders = [math.floor(100*random.uniform(0,1)) for i in dates] 
-            gmv = [100*x*random.uniform(0,1) for x in orders]
-            df_new = pd.DataFrame({
-                'dates': dates,
-                'orders': orders,
-                'gmv': gmv,
-                'region': region,
-                'source': source
-            })
-            if cnt==0:
-                df = df_new
-            else:
-                df=pd.concat([df,df_new])
-            cnt+=1  
-    outfile = test_data_file_full_path()
-    df = df.round({'orders': 0, 'gmv': 2})    
-    df['orders'] = df['orders'].astype(int) 
-    df.to_csv(outfile, index=False)    
-    
-                      
-    return df
+def create_test_data(seed=0):
+    """
+    creates a test.csv data file which we can run tests against and users can practice with: orders and gmv for
+    every region, source and month (6 regions x 4 sources x 21 months).  See generate_data for larger datasets.
+    """
+    periods = 21
+    rows = periods*len(REGIONS)*len(SOURCES)
+    outfile = generate_data(
+        rows, test_data_file_full_path(), fmt='csv', dims={'region': REGIONS, 'source': SOURCES},
+        start='2022-01-01', periods=periods, freq=pd.offsets.MonthEnd(), seed=seed, grid=True
+    )
+    return pd.read_csv(outfile, parse_dates=['dates'])
 
 
 def set_snowflake_credentials(login='',role=''):
@@ -75,6 +65,7 @@ def set_snowflake_credentials(login='',role=''):
     """
     assert login!='', 'you must specify your login'
     assert role!='', 'you must specify your role'
+    ensure_setup()
     env_file = env_file_full_path()
     new_env_file = 'new.env'
 
@@ -131,6 +122,49 @@ def get_warehouse():
     """    
     return DB_SETTINGS['CURRENT_WAREHOUSE']
 
+def set_cache_format(fmt):
+    """
+    ammends the FORMAT property of CACHE_SETTINGS object; one of 'parquet' or 'feather'
+    """
+    assert fmt in CACHE_FORMATS, f"cache format must be one of {list(CACHE_FORMATS)}"
+    CACHE_SETTINGS['FORMAT']=fmt
+
+def get_cache_format():
+    """
+    retrieves the FORMAT property of CACHE_SETTINGS object
+    """
+    return CACHE_SETTINGS['FORMAT']
+
+def set_cache_policy(max_bytes=None, max_entries=None, ttl=None, template_ttl=None):
+    """
+    sets the eviction policy of the result cache, which is enforced whenever a result is cached:
+
+    max_bytes - max total size of the cache
+    max_entries - max number of cached results
+    ttl - max age, in seconds, of a cached result
+    template_ttl - dict of {template: max age in seconds}, overriding ttl for those templates
+
+    least recently used results are evicted first.  Pass None to remove a limit.
+    """
+    CACHE_SETTINGS['MAX_BYTES'] = max_bytes
+    CACHE_SETTINGS['MAX_ENTRIES'] = max_entries
+    CACHE_SETTINGS['TTL'] = ttl
+    CACHE_SETTINGS['TEMPLATE_TTL'] = dict(template_ttl or {})
+
+def get_cache_policy():
+    """
+    retrieves the eviction policy properties of CACHE_SETTINGS object
+    """
+    return {k: CACHE_SETTINGS[k] for k in ['MAX_BYTES','MAX_ENTRIES','TTL','TEMPLATE_TTL']}
+
+def set_csv_ingest(ingest=True):
+    """
+    turns csv ingest on or off.  When on, each local .csv referenced by a query is converted once into a parquet
+    copy (in the workspace's cache/ingest dir) and the compiled sql reads that instead, which is much faster to
+    scan repeatedly and lets duckdb push projections and filters down into the file.
+    """
+    CACHE_SETTINGS['INGEST_CSV'] = bool(ingest)
+
 def get_db_settings():
     print('Current DB Settings are:')
     print(DB_SETTINGS)
@@ -151,6 +185,7 @@ def set_workspace(root='',name=''):
         name = 'main'    
 
     # first rewrite .env file to reflect the root and name
+    ensure_setup()
     env_file = env_file_full_path()
     new_env_file = 'new.env'
 
@@ -176,10 +211,35 @@ def env_reload():
         env_file_full_path(),
         override=True
     ) 
+    clear_template_cache()
     return setup_local_dirs()
 
+# process-wide jinja environments (one per workspace search path) and memo of rendered sql
+_ENVIRONMENTS = {}
+_RENDERED_SQL = OrderedDict()
+_RENDER_LOCK = threading.Lock()
+RENDER_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=256)
+def _string_template(environment, source):
+    """
+    returns the jinja Template for an ad-hoc sql string, compiled once per environment
+    """
+    return environment.from_string(source)
+
+def clear_template_cache():
+    """
+    drops all cached jinja environments and rendered sql; called whenever the workspace changes
+    """
+    with _RENDER_LOCK:
+        _ENVIRONMENTS.clear()
+        _RENDERED_SQL.clear()
+    _string_template.cache_clear()
+    _referenced_templates.cache_clear()
+
 def env_edit():
     # filename = os.path.join(Path(__file__).parents[0],'.env')
+    ensure_setup()
     filename = env_file_full_path()
     os.system(f'open {filename}') 
 
@@ -188,12 +248,14 @@ def env_edit():
         Path(filename),                    
         override=True
     ) 
+    clear_template_cache()
     setup_local_dirs()
 
 def get_ws():
     """
     get workspace root and name
     """    
+    ensure_setup()
     if "WORKSPACE_ROOT" not in os.environ:
         ws_dir = os.path.join(Path(__file__).parents[0],'workspaces')
     else:
@@ -302,22 +364,67 @@ WORKSPACE_NAME = ''""")
                 
 
 
-# Initial setup when pydqt is imported
-# user_dir = setup_local_dirs()
-setup_env()
-USER_DIR = env_reload()
+_SETUP_DONE = False
+
+def ensure_setup():
+    """
+    runs the one-off setup pydqt needs before a workspace is used: creates the .env file (if missing), the
+    workspace directories and the test data.  Called on first use (see get_ws) rather than at import, so importing
+    pydqt is fast and writes nothing.
+    """
+    global _SETUP_DONE
+    if _SETUP_DONE:
+        return
+    _SETUP_DONE = True
+    try:
+        setup_env()
+    except OSError as e:
+        print(f'could not create {env_file_full_path()} ({e}) - using environment variables only')
+    # the .env was already loaded (with override) at import; loading it again with override would undo any
+    # environment variables set since, so only fill in what is still missing
+    load_dotenv(env_file_full_path(), override=False)
+    clear_template_cache()
+    setup_local_dirs()
+    if not test_data_exists():
+        try:
+            create_test_data()
+        except OSError:
+            pass
+
+# Initial setup when pydqt is imported; only reads the .env file (if there is one)
+load_dotenv(env_file_full_path(), override=True)
 DB_SETTINGS={}
 DB_SETTINGS['CURRENT_SCHEMA'] = os.getenv("SNOWFLAKE_DEFAULT_SCHEMA")
 DB_SETTINGS['CURRENT_DATABASE'] = os.getenv("SNOWFLAKE_DEFAULT_DATABASE")
 role = os.getenv("SNOWFLAKE_ROLE")
 DB_SETTINGS['CURRENT_WAREHOUSE'] = f"{role}_QUERY_LARGE_WH"
 
-
-if not test_data_exists():
-    create_test_data()
-
-def py_connect_db(warehouse = get_warehouse(), database=get_database(), schema=get_schema()) -> snowflake.connector.connection.SnowflakeConnection:
+# cached results are written in one of these formats; data.csv is only ever read (legacy caches)
+CACHE_FORMATS = {
+    'parquet': 'data.parquet',
+    'feather': 'data.arrow',
+}
+LEGACY_CACHE_FILE = 'data.csv'
+CACHE_SCHEMA_FILE = 'schema.json'
+CACHE_INDEX_FILE = 'index.json'
+# folders not in the cache manifest are left alone for this long, as they may still be being written
+UNINDEXED_GRACE_SECONDS = 600
+CACHE_SETTINGS={}
+CACHE_SETTINGS['FORMAT'] = 'parquet'
+CACHE_SETTINGS['COMPRESSION'] = 'zstd'
+# eviction policy, enforced whenever a result is cached (None means no limit)
+CACHE_SETTINGS['MAX_BYTES'] = None
+CACHE_SETTINGS['MAX_ENTRIES'] = None
+CACHE_SETTINGS['TTL'] = None
+CACHE_SETTINGS['TEMPLATE_TTL'] = {}
+# convert local csv sources to parquet on first use (see set_csv_ingest)
+CACHE_SETTINGS['INGEST_CSV'] = False
+
+
+def py_connect_db(warehouse = get_warehouse(), database=get_database(), schema=get_schema()) -> 'snowflake.connector.connection.SnowflakeConnection':
     """connect to snowflake, ensure SNOWFLAKE_LOGIN defined in .env"""
+    # imported here as the snowflake connector is slow to import and not needed for local (duckdb) work
+    import snowflake.connector
 
 
     load_dotenv(
@@ -391,6 +498,201 @@ def py_connect_db(warehouse = get_warehouse(), database=get_database(), schema=g
 
 
 
+POOL = ConnectionPool(connect=py_connect_db)
+atexit.register(POOL.close_all)
+
+def get_connection(warehouse='', database='', schema=''):
+    """
+    checks out a snowflake connection from the connection pool, as a context manager:
+
+        with get_connection(database='my_database', schema='my_schema') as conn:
+            ...
+
+    blank params default to the current DB_SETTINGS.  Connections are pooled by (warehouse, database, schema, role)
+    so repeated queries reuse an authenticated session rather than opening a new one each time.
+    """
+    warehouse = warehouse or get_warehouse()
+    database = database or get_database()
+    schema = schema or get_schema()
+    key = (warehouse, database, schema, os.getenv("SNOWFLAKE_ROLE"))
+    return POOL.checkout(key, warehouse=warehouse, database=database, schema=schema)
+
+def close_all():
+    """
+    closes all pooled snowflake connections
+    """
+    POOL.close_all()
+
+_DUCKDB_CONNECTIONS = {}
+_DUCKDB_LOCK = threading.Lock()
+_DUCKDB_LOCAL = threading.local()
+
+def get_duckdb_file(workspace_dir=None):
+    """
+    returns the location of a workspace's persistent duckdb database; defaults to the current workspace's
+    """
+    if workspace_dir is None:
+        workspace_dir = os.path.join(*get_ws())
+    return os.path.join(workspace_dir,'cache','pydqt.duckdb')
+
+def get_duckdb(workspace_dir=None):
+    """
+    returns the persistent duckdb connection of a workspace (defaults to the current workspace), opening it
+    on first use.  Every parquet cached Query result is registered in its 'cache' schema as a view so local sql
+    can join and aggregate across cached extracts, eg:
+
+        get_duckdb().sql('select region, sum(gmv) from cache.sales_1a2b3c4d group by 1').df()
+
+    Feather caches are only visible to sql run through Workspace.sql or Query(engine='duckdb') (see
+    attach_cache_tables).
+
+    duckdb only lets one process open a database file, so if another process holds it an in-memory
+    database (with the same views) is used instead.
+    """
+    import duckdb
+    db_file = get_duckdb_file(workspace_dir)
+    opened = False
+    with _DUCKDB_LOCK:
+        con = _DUCKDB_CONNECTIONS.get(db_file)
+        if con is None:
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+            try:
+                con = duckdb.connect(db_file)
+            except duckdb.IOException:
+                print(f'{db_file} is in use by another process - using an in-memory duckdb database instead')
+                con = duckdb.connect()
+            con.execute('CREATE SCHEMA IF NOT EXISTS cache')
+            _DUCKDB_CONNECTIONS[db_file] = con
+            opened = True
+    if opened:
+        sync_cache_views(os.path.join(os.path.dirname(db_file),'snowflake'))
+    return con
+
+@atexit.register
+def close_duckdb():
+    """
+    closes all open workspace duckdb connections
+    """
+    with _DUCKDB_LOCK:
+        for con in _DUCKDB_CONNECTIONS.values():
+            try:
+                con.close()
+            except Exception:
+                pass
+        _DUCKDB_CONNECTIONS.clear()
+    _DUCKDB_LOCAL.__dict__.clear()
+
+def duckdb_connection():
+    """
+    returns this thread's cursor onto the current workspace's duckdb database (a duckdb connection must not
+    be used by several threads at once)
+    """
+    db_file = get_duckdb_file()
+    cursors = _DUCKDB_LOCAL.__dict__.setdefault('cursors', {})
+    if db_file not in cursors or db_file not in _DUCKDB_CONNECTIONS:
+        cursors[db_file] = get_duckdb().cursor()
+    return cursors[db_file]
+
+def cache_view_name(template, key):
+    """
+    returns the name of the view a cached result is registered under in the workspace duckdb database
+    """
+    stem = os.path.basename(template or 'query').lower().replace('.sql','')
+    return re.sub(r'\W+', '_', stem) + '_' + key[:8]
+
+def _quote(s):
+    return "'" + str(s).replace("'", "''") + "'"
+
+def register_cache_view(root, key, entry):
+    """
+    registers a parquet cached result as a view, cache.<view>, over its file in the workspace duckdb database, if
+    it is open.  Feather caches (which duckdb can't scan) aren't copied into the database; they're attached lazily,
+    zero copy, to the cursors that query them (see attach_cache_tables).
+    """
+    con = _DUCKDB_CONNECTIONS.get(os.path.join(os.path.dirname(root),'pydqt.duckdb'))
+    if con is None or 'view' not in entry:
+        return
+    data_file = os.path.join(root, key, entry['data'])
+    cur = con.cursor()
+    try:
+        # also drops tables that older versions copied feather caches into
+        _drop_cache_object(cur, entry['view'])
+        if data_file.endswith('.parquet'):
+            cur.execute(f'CREATE OR REPLACE VIEW cache."{entry["view"]}" AS SELECT * FROM read_parquet({_quote(data_file)})')
+    finally:
+        cur.close()
+
+_CACHE_REFERENCE = re.compile(r'\bcache\.(?:"([^"]+)"|(\w+))', re.I)
+
+def attach_cache_tables(cur, sql, root=None):
+    """
+    makes the feather caches that sql references as cache.<view> queryable on duckdb cursor cur and returns the
+    sql to run.  Each one is exposed as a temporary view of cur over the memory-mapped file (so nothing is copied)
+    and its references in sql are rewritten to that view.
+    """
+    if 'cache.' not in sql.lower():
+        return sql
+    root = root or cache_root()
+    feathers = {
+        entry['view']: os.path.join(root, key, entry['data'])
+        for key, entry in get_cache_index(root).entries().items()
+        if 'view' in entry and entry['data']==CACHE_FORMATS['feather']
+    }
+    attached = {}
+    def attach(m):
+        view = m.group(1) or m.group(2)
+        if view not in feathers:
+            return m.group(0)
+        if view not in attached:
+            attached[view] = f'__pydqt_cache_{view}'
+            cur.from_arrow(feather.read_table(feathers[view], memory_map=True)).create_view(attached[view], replace=True)
+        return f'"{attached[view]}"'
+    return _CACHE_REFERENCE.sub(attach, sql)
+
+def _drop_cache_object(cur, name):
+    # duckdb refuses to DROP TABLE a view (and vice versa) so look up what it is first
+    found = cur.execute(
+        f"SELECT table_type FROM information_schema.tables WHERE table_schema='cache' AND table_name={_quote(name)}"
+    ).fetchall()
+    if found:
+        kind = 'VIEW' if found[0][0]=='VIEW' else 'TABLE'
+        cur.execute(f'DROP {kind} cache."{name}"')
+
+def drop_cache_views(root, views):
+    """
+    drops the views (or tables) of cached results from the workspace duckdb database, if it is open
+    """
+    con = _DUCKDB_CONNECTIONS.get(os.path.join(os.path.dirname(root),'pydqt.duckdb'))
+    if con is None:
+        return
+    cur = con.cursor()
+    try:
+        for view in views:
+            _drop_cache_object(cur, view)
+    finally:
+        cur.close()
+
+def sync_cache_views(root=None):
+    """
+    (re)registers every result in a cache dir's manifest as a view in its workspace duckdb database, and drops
+    views of results that are no longer cached
+    """
+    root = root or cache_root()
+    con = _DUCKDB_CONNECTIONS.get(os.path.join(os.path.dirname(root),'pydqt.duckdb'))
+    if con is None:
+        return
+    import duckdb
+    entries = get_cache_index(root).entries()
+    views = {entry['view'] for entry in entries.values() if 'view' in entry}
+    existing = [r[0] for r in con.cursor().execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_schema='cache'").fetchall()]
+    drop_cache_views(root, [v for v in existing if v not in views])
+    for key, entry in entries.items():
+        try:
+            register_cache_view(root, key, entry)
+        except (duckdb.Error, OSError):
+            pass
+
 def files_are_equal(f1,f2) -> bool:
     """
     compares two text files to see if they are the same
@@ -406,24 +708,708 @@ def files_are_equal(f1,f2) -> bool:
 def describe_df(df):
     return f'{df.shape[0]} rows, {df.shape[1]} cols'
 
-def cache_dir(template: str='', **kwargs):
+# quoted strings / identifiers and /* */ comments are kept as is; a -- comment keeps the newline that ends it
+_SQL_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|/\*.*?\*/)|(--[^\n]*)(?:\n\s*)?|(\s+)""", re.S)
+
+def sql_literal(value):
+    """
+    returns value as a sql literal (timestamps as TIMESTAMP '...', strings quoted, numbers as is)
+    """
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return f"TIMESTAMP '{pd.Timestamp(value).isoformat(sep=' ')}'"
+    if isinstance(value, str):
+        return _quote(value)
+    if hasattr(value, 'item'):
+        value = value.item()
+    return repr(value)
+
+def normalize_sql(sql):
+    """
+    returns sql with runs of whitespace (outside quoted strings/identifiers and comments) collapsed to a single
+    space and any trailing semicolon removed, so that trivially different renderings of the same query compare
+    equal.  -- comments still end at a newline, so text after one isn't folded into it.
+    """
+    sql = _SQL_TOKENS.sub(lambda m: m.group(1) or (m.group(2).rstrip() + '\n' if m.group(2) else ' '), sql)
+    return sql.strip().rstrip(';').strip()
+
+def sql_fingerprint(sql):
+    """
+    returns a hash of sql after normalize_sql
+    """
+    return hashlib.sha256(normalize_sql(sql).encode('utf-8')).hexdigest()
+
+def cache_key(sql, engine='snowflake', database='', schema=''):
+    """
+    returns the content-addressed cache key for a query; a hash of its normalized compiled sql (a string, or a
+    Sql object, whose fingerprint is computed once) plus the engine and database context it runs in
+    """
+    fingerprint = sql.fingerprint if isinstance(sql, Sql) else sql_fingerprint(sql)
+    h = hashlib.sha256()
+    for part in [engine, database or '', schema or '', fingerprint]:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:32]
+
+def cache_root():
+    """
+    returns dir loc of the current workspace's result cache
+    """
+    ws_root, ws_name = get_ws()
+    return os.path.join(ws_root,ws_name,'cache/snowflake')
+
+def partition_cache_root():
+    """
+    returns dir loc of the current workspace's partitioned result caches (see Query.partition_by), which have their
+    own manifest, keyed by each partition's path relative to this dir
+    """
+    ws_root, ws_name = get_ws()
+    return os.path.join(ws_root,ws_name,'cache/partitions')
+
+def cache_dir(key):
+    """
+    returns dir loc of cache data for a cache key (a folder containing parquet/feather data, its schema.json
+    and a .sql file of compiled sql)
+    """
+    return os.path.join(cache_root(),key)
+
+def legacy_cache_dir(template: str='', **kwargs):
     """
-    returns dir loc of cache data (a folder containing .csv data and a .sql fileof compiled sql)
+    returns dir loc of cache data written by older versions of pydqt, which named cache folders after the
+    template and its params
     """
     fn=template.lower().replace('.sql','')
 
-    if len(kwargs.items())>0:
-        for i, (key, val) in enumerate(kwargs.items()):
-            if type(val)==list:
-                fn = fn + '__' + key + '__' + "|".join(val)
-            elif (type(val)==int) | (type(val)==float): 
-                fn = fn + '__' + key + '__' + str(val)
+    for key, val in kwargs.items():
+        if isinstance(val, (list, tuple)):
+            val = "|".join(str(v) for v in val)
+        fn = fn + '__' + key + '__' + str(val)
+    return os.path.join(cache_root(),fn)
+
+class CacheIndex:
+    """
+    Manifest of a workspace's result cache, stored in cache/snowflake/index.json.  It maps each cache key
+    to its files, size in bytes, row count, created time, last access time, hit count and source
+    template/params.
+
+    Lookups are dictionary probes against an in-memory copy of the manifest, which is only re-read when
+    the file has been changed (eg by another process).  Cache hits are recorded in memory and written out
+    with the next change to the manifest (or at exit).  The index also counts hits and misses for this
+    process in .hits and .misses.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.filename = os.path.join(root, CACHE_INDEX_FILE)
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._pending = {}  # key -> (last_access, unsaved hits)
+        self._mtime = None
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f'CacheIndex(root=\'{self.root}\', entries={len(self.entries())})'
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime!=self._mtime:
+            entries = {}
+            if mtime is not None:
+                try:
+                    with open(self.filename, 'r') as fobj:
+                        entries = json.load(fobj)
+                except ValueError:
+                    # half-written by another process; keep what we have and retry next time
+                    return
+            self._entries = entries
+            self._mtime = mtime
+            for key, (last_access, hits) in self._pending.items():
+                self._apply_hits(key, last_access, hits)
+
+    def _apply_hits(self, key, last_access, hits):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry['last_access'] = max(entry.get('last_access', 0), last_access)
+            entry['hits'] = entry.get('hits', 0) + hits
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        temp_filename = f'{self.filename}.{uuid.uuid4()}.tmp'
+        with open(temp_filename, 'w') as fobj:
+            json.dump(self._entries, fobj, default=str)
+        os.replace(temp_filename, self.filename)
+        self._mtime = os.stat(self.filename).st_mtime_ns
+        self._pending.clear()
+
+    def get(self, key):
+        with self._lock:
+            self._refresh()
+            return self._entries.get(key)
+
+    def entries(self):
+        with self._lock:
+            self._refresh()
+            return dict(self._entries)
+
+    def put(self, key, entry):
+        self.put_many({key: entry})
+
+    def put_many(self, entries):
+        """
+        adds (or replaces) several entries with one write of the manifest
+        """
+        with self._lock:
+            self._refresh()
+            for key, entry in entries.items():
+                entry.setdefault('last_access', entry.get('created', time.time()))
+                entry.setdefault('hits', 0)
+                self._entries[key] = entry
+            self._save()
+
+    def remove(self, *keys):
+        with self._lock:
+            self._refresh()
+            removed = [self._entries.pop(key) for key in keys if key in self._entries]
+            if removed:
+                self._save()
+        MEMORY_CACHE.invalidate(*[(self.root, key) for key in keys])
+        drop_cache_views(self.root, [entry['view'] for entry in removed if 'view' in entry])
+
+    def record_hit(self, key):
+        """
+        records a cache hit on key (in memory; saved with the next manifest write or flush)
+        """
+        with self._lock:
+            now = time.time()
+            last_access, hits = self._pending.get(key, (0, 0))
+            self._pending[key] = (now, hits + 1)
+            self._apply_hits(key, now, 1)
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def flush(self):
+        """
+        writes any unsaved hits to the manifest
+        """
+        with self._lock:
+            if self._pending:
+                self._refresh()
+                self._save()
+
+class MemoryCache:
+    """
+    In-process LRU cache of query results which sits in front of the disk cache.  Entries are keyed by
+    (cache dir, cache key), the same key as the disk cache, and the cache is bounded by a byte budget
+    (max_bytes; 0 disables it) measured with DataFrame.memory_usage(deep=True).
+
+    get() returns a shallow copy of the cached dataframe, so results are shared rather than copied.
+    Treat them as read-only, or enable pandas copy-on-write (pd.set_option('mode.copy_on_write', True))
+    so that modifying a result never changes the cached frame.
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (df, n_bytes)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'MemoryCache(max_bytes={self.max_bytes}, {self.stats()})'
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0].copy(deep=False)
+
+    def put(self, key, df):
+        if not self.max_bytes:
+            return
+        n_bytes = int(df.memory_usage(deep=True, index=True).sum())
+        with self._lock:
+            self._pop(key)
+            if n_bytes > self.max_bytes:
+                return
+            self._entries[key] = (df.copy(deep=False), n_bytes)
+            self.bytes += n_bytes
+            self._trim()
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._trim()
+
+    def _pop(self, key):
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+
+    def _trim(self):
+        while self._entries and self.bytes > self.max_bytes:
+            self.bytes -= self._entries.popitem(last=False)[1][1]
+
+MEMORY_CACHE = MemoryCache()
+
+def set_memory_cache(max_bytes):
+    """
+    sets the byte budget of the in-memory result cache, which serves repeat Query.load() calls without
+    re-reading the disk cache.  0 (the default) disables it.
+    """
+    assert max_bytes>=0, "max_bytes must be >= 0"
+    MEMORY_CACHE.resize(max_bytes)
+
+_CACHE_INDEXES = {}
+_CACHE_INDEXES_LOCK = threading.Lock()
+
+def get_cache_index(root=None):
+    """
+    returns the CacheIndex (manifest) of a result cache dir; defaults to the current workspace's
+    """
+    root = root or cache_root()
+    with _CACHE_INDEXES_LOCK:
+        if root not in _CACHE_INDEXES:
+            _CACHE_INDEXES[root] = CacheIndex(root)
+        return _CACHE_INDEXES[root]
+
+@atexit.register
+def _flush_cache_indexes():
+    for index in list(_CACHE_INDEXES.values()):
+        try:
+            index.flush()
+        except OSError:
+            pass
+
+def cache_entry_expired(entry, now=None):
+    """
+    returns True if a cache manifest entry is older than the TTL for its template (see set_cache_policy)
+    """
+    ttl = CACHE_SETTINGS['TEMPLATE_TTL'].get(entry.get('template'), CACHE_SETTINGS['TTL'])
+    if ttl is None:
+        return False
+    return (now or time.time()) - entry['created'] > ttl
+
+def _dir_usage(dir_loc):
+    """
+    returns (bytes, latest mtime) over the files under dir_loc
+    """
+    n_bytes, latest = 0, os.stat(dir_loc).st_mtime
+    for dirpath, _, filenames in os.walk(dir_loc):
+        for f in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, f))
+            except FileNotFoundError:
+                continue
+            n_bytes += stat.st_size
+            latest = max(latest, stat.st_mtime)
+    return n_bytes, latest
+
+_CACHE_KEY = re.compile(r'[0-9a-f]{32}')
+
+def unindexed_cache_dirs(root=None, now=None, grace=None):
+    """
+    returns {folder name: entry} for the folders in a result cache dir (defaults to the current workspace's) which
+    aren't in its manifest, where entry is like a manifest entry ('bytes', 'created', 'last_access', plus 'legacy').
+    These are either legacy caches, written by older versions of pydqt in folders named after their template and
+    params (which are still served), or orphaned key folders, whose manifest entry was lost (eg when two processes
+    updated the manifest at once).  Folders changed in the last grace seconds are skipped, as they may still be
+    being written.
+    """
+    root = root or cache_root()
+    now = now or time.time()
+    grace = UNINDEXED_GRACE_SECONDS if grace is None else grace
+    indexed = get_cache_index(root).entries()
+    # partition manifests are keyed by <dataset>/<partition>/..., so a dataset folder counts as indexed
+    indexed = set(indexed) | {key.split('/')[0] for key in indexed}
+    unindexed = {}
+    try:
+        names = [e.name for e in os.scandir(root) if e.is_dir() and e.name not in indexed]
+    except FileNotFoundError:
+        return unindexed
+    for name in names:
+        try:
+            n_bytes, latest = _dir_usage(os.path.join(root, name))
+        except FileNotFoundError:
+            continue
+        if now - latest < grace:
+            continue
+        unindexed[name] = {
+            'bytes': n_bytes,
+            'created': latest,
+            'last_access': latest,
+            'hits': 0,
+            'template': None,
+            'legacy': not _CACHE_KEY.fullmatch(name),
+        }
+    return unindexed
+
+def prune_cache(root=None, max_bytes=None, max_entries=None, ttl=None, template_ttl=None, keep=(), dry_run=False):
+    """
+    evicts entries from a result cache dir (defaults to the current workspace's) and returns their keys.  Any
+    policy left as None falls back to CACHE_SETTINGS (see set_cache_policy):
+
+     - entries older than ttl seconds (or template_ttl[template] seconds for their template) are removed
+     - then least recently used entries are removed until there are at most max_entries entries
+       and they take up at most max_bytes bytes
+
+    Folders which aren't in the manifest (see unindexed_cache_dirs) are evicted too: orphaned key folders always
+    (they can never be served), legacy cache folders by the same policy as entries (their last modified time counts
+    as their creation and last access time).  keys in keep are never evicted.  If dry_run is True nothing is deleted.
+    """
+    max_bytes = max_bytes if max_bytes is not None else CACHE_SETTINGS['MAX_BYTES']
+    max_entries = max_entries if max_entries is not None else CACHE_SETTINGS['MAX_ENTRIES']
+    ttl = ttl if ttl is not None else CACHE_SETTINGS['TTL']
+    template_ttl = {**CACHE_SETTINGS['TEMPLATE_TTL'], **(template_ttl or {})}
+    if max_bytes is None and max_entries is None and ttl is None and not template_ttl:
+        return []
+
+    index = get_cache_index(root)
+    now = time.time()
+    unindexed = unindexed_cache_dirs(index.root, now=now)
+    evict = [key for key, entry in unindexed.items() if not entry['legacy'] and key not in keep]
+    entries = {**{k: v for k, v in unindexed.items() if v['legacy']}, **index.entries()}
+    for key, entry in entries.items():
+        entry_ttl = template_ttl.get(entry.get('template'), ttl)
+        if key not in keep and entry_ttl is not None and now - entry['created'] > entry_ttl:
+            evict.append(key)
+
+    # least recently used first
+    remaining = sorted(
+        [(entry.get('last_access', entry['created']), key) for key, entry in entries.items() if key not in evict]
+    )
+    n_entries = len(remaining)
+    n_bytes = sum(entries[key]['bytes'] for _, key in remaining)
+    for _, key in remaining:
+        over_entries = max_entries is not None and n_entries > max_entries
+        over_bytes = max_bytes is not None and n_bytes > max_bytes
+        if not (over_entries or over_bytes):
+            break
+        if key in keep:
+            continue
+        evict.append(key)
+        n_entries -= 1
+        n_bytes -= entries[key]['bytes']
+
+    if evict and not dry_run:
+        index.remove(*[key for key in evict if key not in unindexed])
+        for key in evict:
+            shutil.rmtree(os.path.join(index.root, key), ignore_errors=True)
+    return evict
+
+class CacheWriter:
+    """
+    incrementally writes pandas dataframes or arrow tables/record batches into a cache folder, in parquet or
+    feather format, along with a schema.json of the pandas dtypes.
+
+    Data goes to a temporary file which only replaces the cached data file on close(), so a partially written
+    result is never loaded.  Use as a context manager (the write is abandoned if an exception is raised):
+
+        with CacheWriter(dir_loc, fmt='parquet') as writer:
+            for df in batches:
+                writer.write(df)
+
+    Parquet files are compressed (see CACHE_SETTINGS['COMPRESSION']); feather (arrow ipc) files are
+    left uncompressed so that they can be memory-mapped on load.
+    """
+    def __init__(self, dir_loc, fmt='parquet'):
+        assert fmt in CACHE_FORMATS, f"cache format must be one of {list(CACHE_FORMATS)}"
+        self.dir_loc = dir_loc
+        self.fmt = fmt
+        self.filename = os.path.join(dir_loc, CACHE_FORMATS[fmt])
+        self.temp_filename = f'{self.filename}.{uuid.uuid4()}.tmp'
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, pd.DataFrame):
+            table = pa.Table.from_pandas(data, schema=self.schema, preserve_index=False)
+        elif isinstance(data, pa.RecordBatch):
+            table = pa.Table.from_batches([data])
+        else:
+            table = data
+        if self._writer is not None and table.schema!=self.schema:
+            # the file's schema is fixed by the first write, so later tables must match it
+            table = _cast_columns(table, self.schema)
+        if self._writer is None:
+            self.schema = table.schema
+            if isinstance(data, pd.DataFrame):
+                dtypes = data.dtypes
             else:
-                fn = fn + '__' + key + '__' + val
-    ws_root, ws_name = get_ws()
-    return os.path.join(ws_root,ws_name,'cache/snowflake/',fn)
-    # return os.path.join(USER_DIR,'cache/snowflake/',fn)
-    # return os.path.join(str(Path(__file__).parents[1]),'user/cache/snowflake/',fn)
+                dtypes = self.schema.empty_table().to_pandas().dtypes
+            with open(os.path.join(self.dir_loc, CACHE_SCHEMA_FILE), 'w') as fobj:
+                json.dump({col: str(dtype) for col, dtype in dtypes.items()}, fobj)
+            if self.fmt=='parquet':
+                self._writer = pq.ParquetWriter(self.temp_filename, self.schema, compression=CACHE_SETTINGS['COMPRESSION'])
+            else:
+                self._writer = pa.ipc.new_file(self.temp_filename, self.schema)
+        self._writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        """
+        finishes the write and moves the data into place, returning the name of the data file written
+        """
+        if self._writer is None:
+            # nothing was written so write an empty file
+            self.write(pa.table({}))
+        self._writer.close()
+        os.replace(self.temp_filename, self.filename)
+        # remove data files of any other format so they can never be served stale
+        for other in list(CACHE_FORMATS.values()) + [LEGACY_CACHE_FILE]:
+            other = os.path.join(self.dir_loc, other)
+            if other!=self.filename and os.path.exists(other):
+                os.remove(other)
+        return self.filename
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+
+def write_cache_data(df, dir_loc, fmt='parquet'):
+    """
+    writes df into cache folder dir_loc in the specified format (parquet or feather) along with
+    a schema.json of its pandas dtypes.  Returns the name of the data file written.
+    """
+    with CacheWriter(dir_loc, fmt=fmt) as writer:
+        writer.write(df)
+    return writer.filename
+
+def normalize_arrow_types(table, schema=None):
+    """
+    maps snowflake/duckdb arrow result types onto the pandas dtypes pydqt works with, column by column
+    (no per-row python conversion):
+
+     - DATE columns become timestamps, so they convert to datetime64 (altair only works with datetime NOT date)
+     - NUMBER(p,0) decimals become int64 (when the values fit) and other decimals become float64
+
+    If schema is given (see stream_schema) the columns are cast to its types instead, so that every batch of a
+    stream comes out with the same types whatever its values.
+    """
+    if schema is not None:
+        return _cast_columns(table, schema)
+    for i, field in enumerate(table.schema):
+        column = None
+        if pa.types.is_date(field.type):
+            column = table.column(i).cast(pa.timestamp('ns'))
+        elif pa.types.is_decimal(field.type):
+            if field.type.scale==0:
+                try:
+                    column = table.column(i).cast(pa.int64())
+                except pa.ArrowInvalid:
+                    pass
+            if column is None:
+                column = table.column(i).cast(pa.float64(), safe=False)
+        if column is not None:
+            table = table.set_column(i, pa.field(field.name, column.type), column)
+    return table
+
+def stream_schema(schema):
+    """
+    returns the types the batches of a streamed result are normalized to, chosen from the first batch's schema
+    rather than its values: snowflake sends each batch of a NUMBER column as the smallest integer (or decimal) type
+    its values fit, so integers are widened to int64, NUMBER(p,0) decimals become int64 (float64 when p>18, as such
+    values only arrive as decimals when they don't fit an int64), other decimals float64 and dates timestamps.
+    """
+    fields = []
+    for field in schema:
+        type_ = field.type
+        if pa.types.is_date(type_):
+            type_ = pa.timestamp('ns')
+        elif pa.types.is_signed_integer(type_):
+            type_ = pa.int64()
+        elif pa.types.is_decimal(type_):
+            type_ = pa.int64() if type_.scale==0 and type_.precision<=18 else pa.float64()
+        fields.append(pa.field(field.name, type_))
+    return pa.schema(fields)
+
+def _cast_columns(table, schema):
+    """
+    casts table's columns to the types in schema (decimals to floats may lose precision; anything else must fit)
+    """
+    for i, field in enumerate(schema):
+        column = table.column(i)
+        if column.type!=field.type:
+            lossy = pa.types.is_decimal(column.type) and pa.types.is_floating(field.type)
+            table = table.set_column(i, field, column.cast(field.type, safe=not lossy))
+    return table
+
+def fetch_arrow(conn, sql, profile=None):
+    """
+    runs sql on a snowflake connection and fetches the whole result in the connector's arrow format,
+    returning an arrow table (with types normalized by normalize_arrow_types).  Stage timings and the
+    snowflake query id are recorded in profile, if given.
+    """
+    profile = profile or Profile()
+    cur = conn.cursor()
+    try:
+        with profile.stage('execute'):
+            cur.execute(sql)
+        profile.query_id = getattr(cur, 'sfqid', None)
+        with profile.stage('fetch'):
+            table = cur.fetch_arrow_all()
+            if table is None:
+                # no rows; build an empty table from the cursor description
+                table = pa.table({col[0]: pa.array([], type=pa.null()) for col in cur.description})
+    finally:
+        cur.close()
+    with profile.stage('convert'):
+        return normalize_arrow_types(table)
+
+def read_cache_data(filename):
+    """
+    reads a cached data file (parquet, feather or legacy csv) into a pandas dataframe.  Feather files are
+    memory-mapped and legacy csv files have their dtypes restored from schema.json, if present.
+    """
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    elif filename.endswith('.arrow'):
+        return feather.read_table(filename, memory_map=True).to_pandas()
+    else:
+        schema_file = os.path.join(os.path.dirname(filename), CACHE_SCHEMA_FILE)
+        if not os.path.exists(schema_file):
+            return pd.read_csv(filename, index_col=False)
+        with open(schema_file, 'r') as fobj:
+            schema = json.load(fobj)
+        dates = [col for col, dtype in schema.items() if 'datetime' in dtype]
+        dtypes = {col: dtype for col, dtype in schema.items() if col not in dates}
+        return pd.read_csv(filename, index_col=False, dtype=dtypes, parse_dates=dates)
+
+def iter_cache_batches(filename, batch_size=500000):
+    """
+    yields a cached data file as arrow record batches of up to batch_size rows, without loading it into pandas
+    (legacy csv caches are read with read_cache_data)
+    """
+    if filename.endswith('.parquet'):
+        yield from pq.ParquetFile(filename).iter_batches(batch_size=batch_size)
+    elif filename.endswith('.arrow'):
+        for batch in feather.read_table(filename, memory_map=True).to_batches(max_chunksize=batch_size):
+            yield batch
+    else:
+        yield from pa.Table.from_pandas(read_cache_data(filename), preserve_index=False).to_batches(max_chunksize=batch_size)
+
+def cast_datetimes(batch, write_timestamp=True):
+    """
+    returns an arrow batch with timestamp columns cast to dates if write_timestamp is False (other columns untouched)
+    """
+    if write_timestamp:
+        return batch
+    arrays = [
+        column.cast(pa.date32(), safe=False) if pa.types.is_timestamp(column.type) else column
+        for column in batch.columns
+    ]
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+STAGE_ROW_NUMBER = 'DQT_ROW_NUMBER'
+
+def stage_to_snowflake(conn, table, batches, unique='', parallel=4):
+    """
+    appends arrow record batches to an existing snowflake table via a stage, rather than sql literals:
+
+     - each batch is written to a local snappy compressed parquet file
+     - the files are PUT (in parallel) to the stage of a temporary table like table and COPYed into it
+     - rows are then inserted server-side, or, if unique is given, MERGEd so that only rows whose unique value is
+       not already in table are added (keeping the first row for each unique value)
+
+    columns are matched to table by position, as with INSERT INTO table VALUES (...).  Returns the number of rows staged.
+    """
+    temp_table = f'DQT_STAGE_{uuid.uuid4().hex[:12]}'.upper()
+    stage_dir = os.path.join(tempfile.gettempdir(), temp_table)
+    os.makedirs(stage_dir)
+    cur = conn.cursor()
+    created = False
+    try:
+        n_rows = 0
+        n_fields = None
+        for i, batch in enumerate(batches):
+            if n_fields is None:
+                n_fields = batch.num_columns
+            names = [f'C{j}' for j in range(n_fields)] + [STAGE_ROW_NUMBER]
+            arrays = batch.columns + [pa.array(np.arange(n_rows, n_rows + batch.num_rows, dtype='int64'))]
+            pq.write_table(
+                pa.Table.from_arrays(arrays, names=names),
+                os.path.join(stage_dir, f'{i:06d}.parquet'),
+                compression='snappy',
+                coerce_timestamps='us',
+                allow_truncated_timestamps=True,
+            )
+            n_rows += batch.num_rows
+        if not n_rows:
+            return 0
+
+        columns = [row[0] for row in cur.execute(f"DESCRIBE TABLE {table}").fetchall() if row[2]=='COLUMN']
+        assert len(columns)==n_fields, f"data has {n_fields} columns but {table} has {len(columns)}"
+        select = ', '.join([f'$1:"C{j}"' for j in range(n_fields)] + [f'$1:"{STAGE_ROW_NUMBER}"'])
+        col_list = ', '.join(f'"{c}"' for c in columns)
+        values_list = ', '.join(f's."{c}"' for c in columns)
+
+        cur.execute(f"CREATE TEMPORARY TABLE {temp_table} LIKE {table}")
+        created = True
+        cur.execute(f"ALTER TABLE {temp_table} ADD COLUMN {STAGE_ROW_NUMBER} NUMBER")
+        cur.execute(f"PUT 'file://{stage_dir}/*.parquet' @%{temp_table} PARALLEL={parallel} AUTO_COMPRESS=FALSE")
+        cur.execute(
+            f"COPY INTO {temp_table} FROM (SELECT {select} FROM @%{temp_table}) "
+            f"FILE_FORMAT=(TYPE=PARQUET USE_LOGICAL_TYPE=TRUE) PURGE=TRUE"
+        )
+        if unique:
+            matches = [c for c in columns if c.upper()==unique.upper()]
+            assert matches, f'"{unique}" is not in the columns of {table}'
+            key = f'"{matches[0]}"'
+            cur.execute(f"""
+                MERGE INTO {table} t
+                USING (
+                    SELECT * FROM {temp_table}
+                    -- only the first record for each unique value is inserted
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY {STAGE_ROW_NUMBER}) = 1
+                ) s
+                ON t.{key} = s.{key}
+                WHEN NOT MATCHED THEN INSERT ({col_list}) VALUES ({values_list})
+            """)
+        else:
+            cur.execute(f"INSERT INTO {table} ({col_list}) SELECT {col_list} FROM {temp_table} ORDER BY {STAGE_ROW_NUMBER}")
+        return n_rows
+    finally:
+        # connections are pooled, so the temporary table would otherwise outlive this call in the session
+        if created:
+            try:
+                cur.execute(f"DROP TABLE IF EXISTS {temp_table}")
+            except Exception:
+                pass
+        cur.close()
+        shutil.rmtree(stage_dir, ignore_errors=True)
 
 def temp_sql_compiled_template_dir():
     ws_root, ws_name = get_ws()
@@ -435,10 +1421,12 @@ class Workspace:
     """
     Workspace class which gets current workspace upon object instantiation.
 
-    Workspace objects have two methods:
+    Workspace objects have these methods:
      
         - export: will export the workspace to a specified location
         - publish: will publish to a specified repo (usually a public repo so users can share workspaces)
+        - cache_stats: reports the size, age and hit counts of the workspace's result cache
+        - prune_cache: evicts cached results according to an eviction policy
     """
     def __init__(self):
         root, name = get_ws()
@@ -463,6 +1451,100 @@ class Workspace:
     def publish(self, repo=''):
         print('publish method has not been implemented yet - todo!')
 
+    @property
+    def cache_root(self):
+        return os.path.join(self.full_path,'cache/snowflake')
+
+    @property
+    def partition_root(self):
+        return os.path.join(self.full_path,'cache/partitions')
+
+    def duckdb(self):
+        """
+        returns the workspace's persistent duckdb connection, where cached results are registered as views
+        in the 'cache' schema (see get_duckdb)
+        """
+        return get_duckdb(self.full_path)
+
+    def sql(self, sql):
+        """
+        runs sql locally on the workspace's duckdb database and returns a dataframe, eg to join or aggregate
+        cached results without downloading them again
+        """
+        cur = self.duckdb().cursor()
+        try:
+            return cur.sql(attach_cache_tables(cur, sql, self.cache_root)).df()
+        finally:
+            cur.close()
+
+    def cache_stats(self):
+        """
+        returns a dict summarising the workspace's result cache (entries, bytes, hits and ages in seconds, plus
+        this process's cache hits and misses) with per-entry details, most recently used first, under 'by_entry'.
+        Folders which aren't in the cache manifest (see unindexed_cache_dirs) are included, with indexed=False, as are
+        the partitions of partitioned caches (see Query.partition_by), with partition=True.
+        """
+        index = get_cache_index(self.cache_root)
+        now = time.time()
+        rows = []
+        n_unindexed = 0
+        for root, partition in [(self.cache_root, False), (self.partition_root, True)]:
+            for key, entry in get_cache_index(root).entries().items():
+                rows.append({
+                    'key': key,
+                    'template': entry.get('template'),
+                    'rows': entry.get('rows'),
+                    'bytes': entry['bytes'],
+                    'hits': entry.get('hits', 0),
+                    'age': now - entry['created'],
+                    'idle': now - entry.get('last_access', entry['created']),
+                    'expired': cache_entry_expired(entry, now),
+                    'indexed': True,
+                    'partition': partition,
+                })
+            unindexed = unindexed_cache_dirs(root, now=now, grace=0)
+            n_unindexed += len(unindexed)
+            for key, entry in unindexed.items():
+                rows.append({
+                    'key': key,
+                    'template': None,
+                    'rows': None,
+                    'bytes': entry['bytes'],
+                    'hits': 0,
+                    'age': now - entry['created'],
+                    'idle': now - entry['last_access'],
+                    'expired': cache_entry_expired(entry, now) if entry['legacy'] else True,
+                    'indexed': False,
+                    'partition': partition,
+                })
+        by_entry = pd.DataFrame(rows, columns=['key','template','rows','bytes','hits','age','idle','expired','indexed','partition'])
+        by_entry = by_entry.sort_values('idle').reset_index(drop=True)
+        return {
+            'entries': len(by_entry),
+            'bytes': int(by_entry['bytes'].sum()),
+            'hits': int(by_entry['hits'].sum()),
+            'oldest': by_entry['age'].max() if len(by_entry) else None,
+            'partitions': int(by_entry['partition'].sum()),
+            'unindexed': n_unindexed,
+            'session_hits': index.hits,
+            'session_misses': index.misses,
+            'memory': MEMORY_CACHE.stats(),
+            'policy': get_cache_policy(),
+            'by_entry': by_entry,
+        }
+
+    def prune_cache(self, max_bytes=None, max_entries=None, ttl=None, template_ttl=None, dry_run=False):
+        """
+        evicts cached results and partitions (see prune_cache) and returns the evicted keys; unspecified limits
+        default to the policy set via set_cache_policy.  The limits apply to results and partitions separately.
+        """
+        evicted = []
+        for root in [self.cache_root, self.partition_root]:
+            evicted += prune_cache(root=root, max_bytes=max_bytes, max_entries=max_entries, ttl=ttl,
+                                   template_ttl=template_ttl, dry_run=dry_run)
+        print(f'{"would evict" if dry_run else "evicted"} {len(evicted)} cached results from {self}')
+        return evicted
+
 
 class QueryTemplateParams:
     """
@@ -476,17 +1558,37 @@ class Sql:
     """
     Sql object which represents the compiled sql from Query.compile() method.
     To access the sql query as string, use Sql.text
+
+    Sql.text is the sql exactly as rendered (and is what gets run).  The pretty-printed version, Sql.formatted,
+    is only computed when the sql is displayed or opened, as formatting very large generated sql is slow.
     """
 
-    def __init__(self, text='',temp_dir = temp_sql_compiled_template_dir()):
-        self.text=sqlparse.format(text, reindent=True, keyword_case='upper')
-        # handle ':LANGUAGE' not working
-        self.text = self.text.replace(':LANGUAGE',':language')
-        self.temp_dir = temp_dir
-        self._remove_temp_sql_files()
+    def __init__(self, text='',temp_dir = None, profile=None):
+        self.text = text
+        self._temp_dir = temp_dir
+        self._profile = profile or Profile()
 
     def __repr__(self):
-        return(self.text)
+        return(self.formatted)
+
+    @functools.cached_property
+    def formatted(self):
+        with self._profile.stage('format'):
+            import sqlparse
+            formatted = sqlparse.format(self.text, reindent=True, keyword_case='upper')
+            # handle ':LANGUAGE' not working
+            return formatted.replace(':LANGUAGE',':language')
+
+    @functools.cached_property
+    def fingerprint(self):
+        """
+        hash of the normalized sql (see normalize_sql); equal for renderings that differ only in whitespace
+        """
+        return sql_fingerprint(self.text)
+
+    @property
+    def temp_dir(self):
+        return self._temp_dir or temp_sql_compiled_template_dir()
 
     def _remove_temp_sql_files(self):
         for f in os.listdir(self.temp_dir):
@@ -497,7 +1599,7 @@ class Sql:
         filename = str(uuid.uuid4())
         filename = os.path.join(self.temp_dir,f'{filename}.sql')
         with open(filename, 'w') as fobj:
-            fobj.write(self.text)
+            fobj.write(self.formatted)
         # print('OPENING')    
         os.system(f'open {filename}')    
 
@@ -527,23 +1629,32 @@ class Query:
 
     takes a sql command or template and specified params to run queries and cache results locally
     """
-    def __init__(self, query='aggregate_user_data.sql', cache=True, **kwargs) -> None:
+    def __init__(self, query='aggregate_user_data.sql', cache=True, cache_format=None, engine=None, partition_by=None, **kwargs) -> None:
 
         self.query = query # query can be sql command string or template file name
         self.sql=None
         self.template=None
         self.cache = cache
+        self.cache_format = cache_format or get_cache_format() # 'parquet' or 'feather'
+        assert self.cache_format in CACHE_FORMATS, f"cache format must be one of {list(CACHE_FORMATS)}"
         self.df = None
         self.tests = {}
-        self.core_attributes = ['template','sql','cache','df','core_attributes','query','csv']
+        assert engine in [None,'duckdb','snowflake'], "engine must be 'duckdb' or 'snowflake'"
+        self._engine = engine # None means detect from the sql
+        if isinstance(partition_by, str):
+            partition_by = [partition_by]
+        self.partition_by = list(partition_by or [])
+        self.core_attributes = ['template','sql','cache','cache_format','engine','partition_by','profile','df','core_attributes','query','csv']
         self.params=QueryParams(disallowed=self.core_attributes,**kwargs)
-        is_template,compiled_sql=compile(self.query, **self.params.__dict__)
-        self.sql = Sql(text=compiled_sql)
+        self.profile = Profile()
+        with self.profile.stage('compile'):
+            is_template,compiled_sql=compile(self.query, **self.params.__dict__)
+        self.sql = Sql(text=compiled_sql, profile=self.profile)
         if is_template:
             self.template=self.query
-            pattern = r'from\s+.*\.csv'
-            matches = re.findall(pattern, self.sql.text, re.MULTILINE | re.IGNORECASE)
-            if len(matches)>0:
+            self.profile.template=self.template
+            # don't cache queries on local data
+            if is_local_sql(self.sql.text):
                 self.cache=False
         else:
             # don't cache adhoc sql queries
@@ -554,9 +1665,43 @@ class Query:
         else:
             self.csv=None
 
+    @property
+    def engine(self):
+        """
+        the engine the query runs on; 'duckdb' for queries on local data files (or when engine='duckdb' was
+        specified, eg to query cached results in the workspace duckdb database), 'snowflake' otherwise
+        """
+        if self._engine:
+            return self._engine
+        if is_local_sql(self.sql.text):
+            return 'duckdb'
+        return 'snowflake'
+
+    @property
+    def view_name(self):
+        """
+        name of the view of this query's cached result in the workspace duckdb database ('cache' schema), if cached
+        """
+        entry = get_cache_index().get(self.get_cache_key()) if self.cache else None
+        if entry and 'view' in entry:
+            return f'cache.{entry["view"]}'
+        return None
+
+    def get_cache_key(self, database='', schema=''):
+        """
+        returns the content-addressed cache key of this query (see cache_key) for the given database and
+        schema (which default to the current DB_SETTINGS)
+        """
+        if self.engine=='duckdb':
+            return cache_key(self.sql, engine=self.engine)
+        return cache_key(self.sql, engine=self.engine, database=database or get_database(), schema=schema or get_schema())
+
     def is_cached(self):
         if self.cache:
-            if (os.path.exists(self.get_cache_files()[0])):
+            entry = get_cache_index().get(self.get_cache_key())
+            if entry and not cache_entry_expired(entry):
+                return True
+            elif self._legacy_cache_files():
                 return True
             else:
                 return False         
@@ -566,15 +1711,39 @@ class Query:
             else:
                 return
     
-    def get_cache_files(self):
+    def get_cache_files(self, database='', schema=''):
         """
-        returns the absolute cache csv file name and compiled sql filename for most recent param values on Query object
+        returns the absolute cache data file name and compiled sql filename for the Query's current sql and database context
 
-        returns a two-tuple, where first element is csv file and second is sql file.
+        returns a two-tuple, where first element is data file and second is sql file.  If the result isn't cached yet,
+        these are where run() will write it.
         """
         if self.sql:
-            dir_loc = cache_dir(self.template,**self.params.__dict__)
-            return (os.path.join(dir_loc,'data.csv'),os.path.join(dir_loc,'data.sql'))
+            key = self.get_cache_key(database=database, schema=schema)
+            entry = get_cache_index().get(key)
+            dir_loc = cache_dir(key)
+            if entry:
+                return (os.path.join(dir_loc,entry['data']),os.path.join(dir_loc,'data.sql'))
+            legacy_files = self._legacy_cache_files()
+            if legacy_files:
+                return legacy_files
+            return (os.path.join(dir_loc,CACHE_FORMATS[self.cache_format]),os.path.join(dir_loc,'data.sql'))
+
+    def _legacy_cache_files(self):
+        """
+        returns (data file, sql file) of a cache folder written by an older version of pydqt, if there is one
+        """
+        if not self.template:
+            return None
+        try:
+            dir_loc = legacy_cache_dir(self.template,**self.params.__dict__)
+            for data_file in list(CACHE_FORMATS.values()) + [LEGACY_CACHE_FILE]:
+                if os.path.isfile(os.path.join(dir_loc,data_file)):
+                    return (os.path.join(dir_loc,data_file),os.path.join(dir_loc,'data.sql'))
+        except (TypeError, ValueError, OSError):
+            # params that older versions couldn't name a folder after (eg dicts or very long lists)
+            pass
+        return None
 
     def __repr__(self):
         df_desc = None
@@ -596,13 +1765,17 @@ params: {self.params}"""
 
     def cache_is_synced(self):
         """
-        return True if cached data's sql matches current sql, False otherwise
+        return True if cached data's sql matches current sql, False otherwise.  Cache entries are keyed by the
+        hash of their sql so this is always True for them; legacy caches have their data.sql compared.
         """ 
         if self.is_cached():
+            if get_cache_index().get(self.get_cache_key()):
+                return True
             sql_file = self.get_cache_files()[1]
-            if len(self.sql.text)>0:
+            if len(self.sql.text)>0 and os.path.exists(sql_file):
                 with open(sql_file, 'r') as fobj:
-                    if fobj.read() == self.sql.text:
+                    # legacy data.sql files hold the formatted sql
+                    if fobj.read() in (self.sql.text, self.sql.formatted):
                         return True
                     else:
                         return False 
@@ -611,26 +1784,96 @@ params: {self.params}"""
         else:
             return False    
 
-    def load(self):
+    def load(self, incremental_on=None, lookback=None):
         """
         loads from cache if present, otherwise call .run()
+
+        For results which only ever gain rows (eg append-only fact tables), pass incremental_on=<column> to refresh
+        a cached result incrementally: only rows with incremental_on greater than its max in the cached data (the
+        watermark) are fetched and appended to the cache.  With lookback (a timedelta for date columns, or a number),
+        rows from watermark - lookback onwards are re-fetched and replace the cached rows in that window, which picks
+        up late-arriving or restated rows.  The watermark is recorded in the cache manifest.
         """
-        if self.is_cached():
-            cache_file=self.csv
-            if self.cache_is_synced():
-                # check data.sql matches current compiled sql - if it doesn't then rerun
-                df = pd.read_csv(self.get_cache_files()[0], index_col=False)
-                self.df=df     
-            else:
+        with self.profile.track('load'):
+            return self._load(incremental_on=incremental_on, lookback=lookback)
+
+    def _load(self, incremental_on=None, lookback=None):
+        if incremental_on and self.is_cached() and self.cache_is_synced() and get_cache_index().get(self.get_cache_key()):
+            return self._load_incremental(incremental_on, lookback)
+        if self.is_cached() and self.cache_is_synced():
+            try:
+                memory_key = (cache_root(), self.get_cache_key())
+                df = MEMORY_CACHE.get(memory_key) if MEMORY_CACHE.max_bytes else None
+                if df is None:
+                    with self.profile.stage('cache_read'):
+                        data_file = self.get_cache_files()[0]
+                        df = read_cache_data(data_file)
+                    self.profile.bytes['cache_read'] = os.path.getsize(data_file)
+                    MEMORY_CACHE.put(memory_key, df)
+                self.df=df
+                self.csv=self.get_cache_files()[0]
+                get_cache_index().record_hit(self.get_cache_key())
+                self.profile.cache = 'hit'
+                self.profile.rows = len(df)
+            except FileNotFoundError:
+                # cache folder was deleted from under the manifest
+                get_cache_index().remove(self.get_cache_key())
                 df = self.run()
                 self.df=df
-
         else:
+            if self.cache:
+                get_cache_index().record_miss()
+                self.profile.cache = 'miss'
             df = self.run()
             self.df=df
+            if incremental_on and self.cache:
+                self._record_watermark(incremental_on, df)
         return self.df
 
+    def _load_incremental(self, column, lookback=None):
+        """
+        loads the cached result and appends (or, with lookback, merges in) the rows newer than its watermark
+        """
+        database, schema = get_database(), get_schema()
+        cached = self.load()
+        assert column in cached.columns, f'"{column}" is not a column of the cached result'
+        watermark = cached[column].max()
+        if pd.isna(watermark):
+            return self.run()
+        if lookback is None:
+            cutoff, op = watermark, '>'
+        else:
+            cutoff, op = watermark - lookback, '>='
+        sql = f"SELECT * FROM (\n{self.sql.text.strip().rstrip(';')}\n) AS dqt_incremental WHERE {column} {op} {sql_literal(cutoff)}"
+        new = self._fetch_arrow(sql, database=database, schema=schema).to_pandas()
+        if lookback is None and len(new)==0:
+            self.df = cached
+        else:
+            keep = cached if lookback is None else cached[cached[column] < cutoff]
+            self.df = pd.concat([keep, new], ignore_index=True)
+            self.write_cache(self.df, database=database, schema=schema)
+        self._record_watermark(column, self.df)
+        return self.df
+
+    def _record_watermark(self, column, df):
+        key = self.get_cache_key()
+        entry = get_cache_index().get(key)
+        if entry:
+            watermark = df[column].max()
+            if hasattr(watermark, 'isoformat'):
+                watermark = watermark.isoformat()
+            elif hasattr(watermark, 'item'):
+                watermark = watermark.item()
+            get_cache_index().put(key, dict(entry, watermark={column: watermark}))
+
     def run(self, database='', schema=''):
+        """
+        runs the query (on snowflake, or duckdb for local data), caches the result and returns it as a dataframe
+        """
+        with self.profile.track('run'):
+            return self._run(database=database, schema=schema)
+
+    def _run(self, database='', schema=''):
         # print(DB_SETTINGS)
         if database=='':
             database=get_database()
@@ -639,111 +1882,363 @@ params: {self.params}"""
             schema=get_schema()
 
         # print('schema is', schema)
-        if '.csv' in self.sql.text:
-            df = duckdb.sql(self.sql.text).df()
-        else:
-            if schema!="":
-                if database!="":
-                    conn = py_connect_db(database=database,schema=schema)
-                else:
-                    conn = py_connect_db(schema=schema)
-            else:
-                if database!="":
-                    conn = py_connect_db(database=database)
-                else:               
-                    conn = py_connect_db()
-            df = pd.read_sql(self.sql.text, conn)
-        # convert any date columns to datetime (altair only works with datetime NOT date)
-
-        if len(df)==0:
+        table = self._fetch_arrow(self.sql.text, database=database, schema=schema)
+        if table.num_rows==0:
             raise NoDataException('Query returned no data.  Please check your query and try again')
-        for col in df.columns:
-            try:
-                if type(df[col][0]) == datetime.date:
-                    df[col] = pd.to_datetime(df[col])
-            except:
-                raise Exception(f'Column error - do you have multiple columns with the same name?')                    
+        if len(set(table.column_names))<table.num_columns:
+            raise Exception(f'Column error - do you have multiple columns with the same name?')
+        self.profile.rows = table.num_rows
+        self.profile.bytes['fetched'] = table.nbytes
+        with self.profile.stage('convert'):
+            df = table.to_pandas()
         if self.cache:
-            params = vars(self)
-            if not os.path.isdir(os.path.dirname(self.get_cache_files()[0])):
-                os.mkdir(os.path.dirname(self.get_cache_files()[0]))
-            df.to_csv(self.get_cache_files()[0], index=False)
-            with open(self.get_cache_files()[1],'w+') as fobj:
-                fobj.write(self.sql.text)
-            self.csv=self.get_cache_files()[0]
+            self.write_cache(df, database=database, schema=schema)
+            prune_cache(keep=[self.get_cache_key(database=database, schema=schema)])
         self.df=df
         return self.df
+
+    def _fetch_arrow(self, sql, database, schema):
+        """
+        runs sql on this Query's engine and returns the result as an arrow table
+        """
+        # results come back as arrow, so dtypes (eg date columns to datetime) are set from the result schema
+        if self.engine=='duckdb':
+            con = duckdb_connection()
+            with self.profile.stage('execute'):
+                con.execute(attach_cache_tables(con, sql))
+            with self.profile.stage('fetch'):
+                table = con.fetch_arrow_table()
+            with self.profile.stage('convert'):
+                return normalize_arrow_types(table)
+        start = time.perf_counter()
+        with get_connection(database=database, schema=schema) as conn:
+            self.profile.add('connect', time.perf_counter() - start)
+            return fetch_arrow(conn, sql, profile=self.profile)
+
+    def write_cache(self, df, database='', schema=''):
+        """
+        writes df (and the compiled sql) into this Query's cache folder and records it in the cache manifest
+        """
+        with self.profile.stage('cache_write'):
+            dir_loc = self._cache_write_dir(database=database, schema=schema)
+            data_file = write_cache_data(df, dir_loc, fmt=self.cache_format)
+            self._register_cache(data_file, len(df), database=database, schema=schema)
+        self.profile.bytes['cache_write'] = os.path.getsize(data_file)
+        MEMORY_CACHE.put((cache_root(), self.get_cache_key(database=database, schema=schema)), df)
+
+    def _cache_write_dir(self, database='', schema=''):
+        dir_loc = cache_dir(self.get_cache_key(database=database, schema=schema))
+        os.makedirs(dir_loc, exist_ok=True)
+        return dir_loc
+
+    def _register_cache(self, data_file, rows, database='', schema=''):
+        """
+        writes data.sql next to a freshly written data_file and adds the entry to the cache manifest
+        """
+        dir_loc = os.path.dirname(data_file)
+        with open(os.path.join(dir_loc,'data.sql'),'w+') as fobj:
+            fobj.write(self.sql.text)
+        files = [os.path.basename(data_file), CACHE_SCHEMA_FILE, 'data.sql']
+        key = self.get_cache_key(database=database, schema=schema)
+        entry = {
+            'data': os.path.basename(data_file),
+            'files': files,
+            'bytes': sum(os.path.getsize(os.path.join(dir_loc,f)) for f in files),
+            'rows': rows,
+            'created': time.time(),
+            'template': self.template,
+            'params': self.params.__dict__,
+            'engine': self.engine,
+            'view': cache_view_name(self.template, key),
+        }
+        get_cache_index().put(key, entry)
+        # make the result queryable locally, as cache.<view> in the workspace duckdb database.  Only if it's already
+        # open: opening it takes duckdb's single-process file lock, and sync_cache_views registers every cached
+        # result when it is opened
+        register_cache_view(cache_root(), key, entry)
+        self.csv=data_file
     
-    def test(self, json_file=''):
+    @classmethod
+    def sweep(cls, template, grid, refresh=False, max_workers=8, max_per_warehouse=4, as_arrow=False, **kwargs):
         """
-        applies tests defined in json/data_tests and returns test results which include a summary of failed records
-        and copies of those records.  Output is saved in self.tests
+        runs template over the cartesian product of the param values in grid and returns all the results as one
+        dataframe (or, with as_arrow=True, an arrow table) with a column for each grid param, eg:
+
+            df = Query.sweep('sales.sql', grid={'region': ['US','GB'], 'min_date': ['2023-01-01','2023-02-01']})
+
+        every combination is compiled once, combinations which compile to the same sql are only run once, cached
+        results are loaded from the cache (unless refresh is True) and the rest run concurrently (see QueryBatch).
+        Other kwargs are passed to every Query.  Combinations which return no data are left out.  If a result
+        already has a column named after a grid param, the param column is called param_<name>.
+        """
+        names = list(grid)
+        combos = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+        queries = [cls(template, **dict(kwargs, **combo)) for combo in combos]
+        batch = run_many(queries, max_workers=max_workers, max_per_warehouse=max_per_warehouse, refresh=refresh)
+        frames = []
+        for i, (query, combo) in enumerate(zip(queries, combos)):
+            if i in batch.errors:
+                if isinstance(batch.errors[i], NoDataException):
+                    continue
+                raise batch.errors[i]
+            frames.append(query.df.assign(**{
+                (f'param_{name}' if name in query.df.columns else name): value for name, value in combo.items()
+            }))
+        if not frames:
+            raise NoDataException('Query returned no data for any combination of the grid')
+        df = pd.concat(frames, ignore_index=True)
+        if as_arrow:
+            return pa.Table.from_pandas(df, preserve_index=False)
+        return df
+
+    @property
+    def partition_root(self):
+        """
+        dir loc of this Query's partitioned cache dataset; one per template, engine, database context and set of
+        params other than the partition_by params
+        """
+        assert self.template and self.partition_by, "partitioned caching needs a template Query with partition_by params"
+        shared = {k: v for k, v in self.params.__dict__.items() if k not in self.partition_by}
+        database, schema = ('', '') if self.engine=='duckdb' else (get_database(), get_schema())
+        h = hashlib.sha256(json.dumps(
+            [self.template, self.engine, database or '', schema or '', self.partition_by, shared],
+            sort_keys=True, default=str,
+        ).encode('utf-8')).hexdigest()[:16]
+        stem = os.path.basename(self.template).lower().replace('.sql','')
+        return os.path.join(partition_cache_root(), f'{stem}_{h}')
+
+    def _partition_query(self, values):
+        params = dict(self.params.__dict__, **values)
+        return Query(self.template, cache=False, engine=self._engine, **params)
+
+    def _partition_dir(self, values):
+        parts = []
+        for k in self.partition_by:
+            v = str(values[k])
+            assert '/' not in v and os.sep not in v, f'partition value {v!r} of {k} cannot contain a path separator'
+            parts.append(f'{k}={v}')
+        return os.path.join(self.partition_root, *parts)
+
+    def _partition_is_cached(self, index, key, dir_loc, query):
+        """
+        returns True if the partition at dir_loc is cached (possibly as empty) for query's current sql and not expired
+        """
+        sql_file = os.path.join(dir_loc, 'data.sql')
+        if not os.path.exists(sql_file):
+            return False
+        with open(sql_file, 'r') as fobj:
+            if fobj.read()!=query.sql.text:
+                return False
+        entry = index.get(key)
+        if entry is None:
+            # written by an older version, without a manifest entry
+            if not os.path.exists(os.path.join(dir_loc, CACHE_FORMATS['parquet'])):
+                return False
+            files = [f for f in [CACHE_FORMATS['parquet'], CACHE_SCHEMA_FILE, 'data.sql'] if os.path.exists(os.path.join(dir_loc, f))]
+            index.put(key, self._partition_entry(dir_loc, files, None, query))
+            return True
+        return not cache_entry_expired(entry)
+
+    def _partition_entry(self, dir_loc, files, rows, query):
+        """
+        returns the partition cache manifest entry of the partition at dir_loc
+        """
+        return {
+            'data': CACHE_FORMATS['parquet'] if CACHE_FORMATS['parquet'] in files else None,
+            'files': files,
+            'bytes': sum(os.path.getsize(os.path.join(dir_loc, f)) for f in files),
+            'rows': rows,
+            'created': time.time(),
+            'template': self.template,
+            'params': query.params.__dict__,
+            'engine': query.engine,
+        }
+
+    def partitions(self):
+        """
+        returns the partition_by param values of every partition cached so far, eg [{'region': 'US'}, ...]
+        """
+        root = self.partition_root
+        found = []
+        for dirpath, _, filenames in os.walk(root):
+            if CACHE_FORMATS['parquet'] in filenames:
+                parts = os.path.relpath(dirpath, root).split(os.sep)
+                found.append(dict(p.split('=', 1) for p in parts))
+        return sorted(found, key=lambda d: [d[k] for k in self.partition_by])
+
+    def load_partitions(self, refresh=False, max_workers=8, **values):
+        """
+        loads partitions of a partitioned cache (see partition_by) in one duckdb scan of the dataset, eg:
+
+            q = Query('sales.sql', partition_by='region', min_date='2023-01-01')
+            df = q.load_partitions(region=['US','GB','DE'])
+
+        each partition is the template's result with the partition_by params set to one combination of the given
+        values, stored under <partition_root>/region=US/...  Partitions which are not cached yet (or whose compiled
+        sql has changed, or which have expired) are run concurrently and added to the dataset first.  With no values,
+        every cached partition is loaded.  The partition_by params are columns of the result.
+
+        Each partition is recorded in the partition cache's manifest (see partition_cache_root), including partitions
+        with no data, which aren't re-run, and is subject to the cache policy (see set_cache_policy).  Requested
+        partitions with no data load as an empty frame; NoDataException is raised if no cached partition has any data.
+        """
+        for k in values:
+            assert k in self.partition_by, f'{k} is not one of the partition_by params {self.partition_by}'
+        if values:
+            assert set(values)==set(self.partition_by), f'give values for all of the partition_by params {self.partition_by}'
+            grid = [dict(zip(values, combo)) for combo in itertools.product(*[v if isinstance(v, (list, tuple)) else [v] for v in values.values()])]
+            index = get_cache_index(partition_cache_root())
+            queries, dirs, keys = [], [], []
+            for combo in grid:
+                query = self._partition_query(combo)
+                dir_loc = self._partition_dir(combo)
+                key = os.path.relpath(dir_loc, index.root).replace(os.sep, '/')
+                keys.append(key)
+                if not refresh and self._partition_is_cached(index, key, dir_loc, query):
+                    index.record_hit(key)
+                    continue
+                queries.append((query, dir_loc, key))
+            if queries:
+                batch = QueryBatch([q for q, _, _ in queries], max_workers=max_workers).run()
+                entries = {}
+                for i, (query, dir_loc, key) in enumerate(queries):
+                    if i in batch.errors and not isinstance(batch.errors[i], NoDataException):
+                        raise batch.errors[i]
+                    os.makedirs(dir_loc, exist_ok=True)
+                    files = ['data.sql']
+                    if i in batch.errors:
+                        # the partition is empty; recorded (without data) so it isn't re-run on every load
+                        rows = 0
+                        for f in list(CACHE_FORMATS.values()) + [CACHE_SCHEMA_FILE]:
+                            if os.path.exists(os.path.join(dir_loc, f)):
+                                os.remove(os.path.join(dir_loc, f))
+                    else:
+                        df = query.df.drop(columns=[c for c in query.df.columns if c in self.partition_by])
+                        write_cache_data(df, dir_loc, fmt='parquet')
+                        rows = len(df)
+                        files += [CACHE_FORMATS['parquet'], CACHE_SCHEMA_FILE]
+                    with open(os.path.join(dir_loc, 'data.sql'), 'w') as fobj:
+                        fobj.write(query.sql.text)
+                    entries[key] = self._partition_entry(dir_loc, files, rows, query)
+                index.put_many(entries)
+                prune_cache(root=index.root, keep=keys)
+
+        root = self.partition_root
+        if not os.path.isdir(root) or next(Path(root).rglob(CACHE_FORMATS['parquet']), None) is None:
+            # duckdb fails to scan a dataset with no files (eg every partition is empty, or all were evicted)
+            raise NoDataException('no partitions with data are cached for this Query')
+        sql = f"SELECT * FROM read_parquet({_quote(os.path.join(root, '**', CACHE_FORMATS['parquet']))}, hive_partitioning=true)"
+        if values:
+            where = []
+            for k in self.partition_by:
+                v = values[k] if isinstance(values[k], (list, tuple)) else [values[k]]
+                where.append(f"CAST({k} AS VARCHAR) IN ({', '.join(_quote(x) for x in v)})")
+            sql += ' WHERE ' + ' AND '.join(where)
+        con = get_duckdb().cursor()
+        try:
+            self.df = normalize_arrow_types(con.execute(sql).arrow()).to_pandas()
+        finally:
+            con.close()
+        return self.df
+
+    def iter_batches(self, batch_size=100000, database='', schema='', cache=None):
+        """
+        runs the query and yields the result as a stream of dataframes of at most batch_size rows, so results
+        larger than memory can be processed chunk by chunk.  Batches are fetched as arrow record batches (via
+        snowflake's fetch_arrow_batches or duckdb's record batch reader) and yielded as they arrive.
+
+        If cache is True (defaults to the Query's cache setting) each batch is also written to the on-disk cache
+        as it arrives; once the stream is exhausted the Query is cached exactly as if run() had been called.
+        Unlike run(), the .df property is not populated.
+        """
+        assert batch_size>0, "batch_size must be a positive number of rows"
+        if cache is None:
+            cache = self.cache
+        if database=='':
+            database=get_database()
+        if schema=='':
+            schema=get_schema()
+
+        writer = None
+        if cache:
+            writer = CacheWriter(self._cache_write_dir(database=database, schema=schema), fmt=self.cache_format)
+        rows = 0
+        types = None
+        try:
+            for batch in self._iter_arrow_batches(batch_size, database, schema):
+                if batch.num_rows==0:
+                    continue
+                types = types or stream_schema(batch.schema)
+                batch = normalize_arrow_types(batch, schema=types)
+                if writer:
+                    writer.write(batch)
+                rows += batch.num_rows
+                yield batch.to_pandas()
+        except BaseException:
+            if writer:
+                writer.abort()
+            raise
+        if rows==0:
+            if writer:
+                writer.abort()
+            raise NoDataException('Query returned no data.  Please check your query and try again')
+        if writer:
+            self._register_cache(writer.close(), rows, database=database, schema=schema)
+            MEMORY_CACHE.invalidate((cache_root(), self.get_cache_key(database=database, schema=schema)))
+            prune_cache(keep=[self.get_cache_key(database=database, schema=schema)])
+
+    def _iter_arrow_batches(self, batch_size, database, schema):
+        """
+        yields the query result as arrow tables of at most batch_size rows
+        """
+        if self.engine=='duckdb':
+            # a dedicated cursor, so the reader can be consumed lazily (and from any thread)
+            con = get_duckdb().cursor()
+            try:
+                reader = con.execute(attach_cache_tables(con, self.sql.text)).fetch_record_batch(batch_size)
+                for batch in reader:
+                    yield pa.Table.from_batches([batch])
+                del reader
+            finally:
+                con.close()
+        else:
+            with get_connection(database=database, schema=schema) as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute(self.sql.text)
+                    for table in cur.fetch_arrow_batches():
+                        for offset in range(0, table.num_rows, batch_size):
+                            yield table.slice(offset, batch_size)
+                finally:
+                    cur.close()
+
+    def test(self, json_file='', failed_records=False, verbose=True):
+        """
+        applies tests defined in workspace/tests/json and returns test results which include a summary of failed
+        records (counts and the index of the failing rows).  Copies of the failing records are only added if
+        failed_records is True.  Output is saved in self.tests
         """
         assert len(self.df)>0,"Query object has no dataframe to test - try Query.run() or Query.load() to produce one"
-        assert json_file!='', "you need to specify a json file (which lives in workspace/json/data_tests)"
-        df=self.df
+        assert json_file!='', "you need to specify a json file (which lives in workspace/tests/json)"
         workspace_dir, workspace_name = get_ws()
         if ".json" not in json_file.lower():
             json_file = json_file + ".json"
         full_json_file = os.path.join(workspace_dir, workspace_name, 'tests/json',json_file)
-        with open(full_json_file,'r') as fobj:
-            x=json.load(fobj)
-            tests=x['tests']  
-            def replace_with_df(match):
-                return f"df[\'{match.group(1)}\']"  
-            test_report = {}
-            for test in tests:
-                print(f'Checking {test["name"]}')
-                pattern = r"'(.*?)'"
-                modified_text = re.sub(pattern, replace_with_df, test['assert'])                
-                # print(modified_text)
-                if ("==" in modified_text) and ("`" not in modified_text):                    
-                    # need to deal with pandas NaN!=NaN - ridiculous!
-                    splits = modified_text.split("==")
-                    assert len(splits)==2, "you cannot have more than one '==' in your assertion.  Check your json test file."
-                    lhs = eval(splits[0].strip())
-                    rhs = eval(splits[1].strip())
-                    if type(lhs)==pd.core.series.Series:
-                        lhs=lhs.fillna(-99999)
-                    if type(rhs)==pd.core.series.Series:
-                        rhs=rhs.fillna(-99999)    
-                    tfs = lhs == rhs
-                else:    
-                    modified_text = modified_text.replace("`","'")
-                    tfs = eval(modified_text)
-                if type(tfs)==pd.core.series.Series:
-                    fails = sum(tfs==False)
-                    print('Number of records which failed: ',fails)
-                    print('Percentage of records that failed: ',str(100*fails/len(df))+'%')
-                    if fails>0:
-                        print('Failed records:')
-                        print(df[tfs==False])
-                        test_report[test["name"]] = {
-                            "fails": fails,
-                            "percentage_fails": 100*fails/len(df),
-                            "failed_records": df[tfs==False]
-                        }
-                    else:
-                        test_report[test["name"]] = "All Passed!"   
-                elif type(tfs)==np.bool_:
-                    if tfs:
-                        print('Test passed!')
-                        test_report[test["name"]] = "Passed"
-                    else:
-                        print('Test failed!')
-                        test_report[test["name"]] = "Failed"    
-            self.tests[json_file.replace('.json','')] = test_report        
+        suite = DataTestSuite.from_json(full_json_file)
+        test_report = suite.run(self.df, failed_records=failed_records, verbose=verbose)
+        self.tests[json_file.replace('.json','')] = test_report
+        return test_report
 
-
-
-    def write_sql(self, table, warehouse=get_warehouse(), database=get_database(), schema=get_schema(), append=False, write_timestamp=True, unique='',**kwargs):
+    def write_sql(self, table, warehouse=get_warehouse(), database=get_database(), schema=get_schema(), append=False, write_timestamp=True, unique='', from_cache=False, chunk_size=500000, parallel=4, **kwargs):
         """
         writes result to sql table.  Note: only works for Snowflake at the moment.  If the table does not exist
         then one is automatically created, which may result in fields being of an unexpected type (eg dates are 
         often converted to integers by Snowflake).  To avoid unexpected results, it is advised to create your table 
         in advance.
 
-        This works by opening a new db connection where you can specify the optional params:
+        Data is uploaded as compressed parquet files to a snowflake stage and loaded server-side (see stage_to_snowflake),
+        so there is no limit on the number of rows.  This works by checking out a pooled db connection where you can
+        specify the optional params:
 
         table - table name    
         warehouse - warehouse
@@ -751,10 +2246,19 @@ params: {self.params}"""
         schema - schema
         append - append to an existing table (default False)                
         write_timestamp - if True then any date / datetime columns are written to SQL as timestamps, if False then written as dates
+        unique - column name; rows whose value of this column is already in the table (or earlier in the data) are not written
+        from_cache - if True, write straight from the query's cached data file rather than self.df (which need not be loaded)
+        chunk_size - number of rows per uploaded parquet file
+        parallel - number of threads used to upload files
         """
-        assert len(self.df)>0,"Query object has no dataframe - try Query.run() or Query.load() to produce one"
-        if append==False:
-            auto_create_table=False
+        if from_cache:
+            assert self.is_cached(), "Query is not cached - try Query.run() or Query.load() to produce a cached result"
+            data_file = self.get_cache_files()[0]
+            df = pq.read_schema(data_file).empty_table().to_pandas() if data_file.endswith('.parquet') else read_cache_data(data_file).iloc[:0]
+            batches = iter_cache_batches(data_file, batch_size=chunk_size)
+        else:
+            assert len(self.df)>0,"Query object has no dataframe - try Query.run() or Query.load() to produce one"
+            df=self.df
         assert table, "you must specify a table name - doesn't matter if it exists already or not"
 
         # SNOWFLAKE_ROLE = os.getenv("SNOWFLAKE_ROLE")
@@ -773,16 +2277,11 @@ params: {self.params}"""
         schema=schema.upper() 
         warehouse=warehouse.upper() 
         database=database.upper()                    
-        conn = py_connect_db(warehouse=warehouse, database=database, schema=schema)
         
-        df=self.df
-        for idx,dtype in enumerate(df.dtypes):
-            if 'date' in str(dtype).lower():
-                col = df.columns[idx]
-                if write_timestamp==True:
-                    df[col] = df[col].dt.strftime('%Y-%m-%d:%H-%M-%S')
-                else:
-                    df[col] = df[col].dt.strftime('%Y-%m-%d')
+        if not from_cache:
+            batches = pa.Table.from_pandas(df, preserve_index=False).to_batches(max_chunksize=chunk_size)
+        # date / datetime columns are written as typed parquet columns; no per-row formatting
+        batches = (cast_datetimes(batch, write_timestamp) for batch in batches)
 
         def get_table_metadata(df,**kwargs):            
             def map_dtypes(x):
@@ -791,7 +2290,7 @@ params: {self.params}"""
                 elif 'bool' in x:
                     return 'BOOLEAN'
                 elif 'date' in x:
-                    return 'DATE'
+                    return 'TIMESTAMP_NTZ' if write_timestamp else 'DATE'
                 elif 'int' in x:
                     return 'NUMERIC'  
                 elif 'float' in x: return 'FLOAT' 
@@ -808,84 +2307,276 @@ params: {self.params}"""
 
             return table_metadata
 
+        if unique:
+            assert unique.upper() in [c.upper() for c in df.columns], f'"{unique}" is not in the dataframe columns'
 
-        def df_to_snowflake_table(table_name, operation, df, conn=conn, unique=unique, **kwargs): 
-            if operation=='create_replace':
-                df.columns = [c.upper() for c in df.columns]
+        with get_connection(warehouse=warehouse, database=database, schema=schema) as conn:
+            if append==False:
                 table_metadata = get_table_metadata(df,**kwargs)
-                conn.cursor().execute(f"CREATE OR REPLACE TABLE {table_name} ({table_metadata})")
-
-                if unique:
-                    assert unique in df.columns, f'"{unique}" is not in the dataframe columns'
-                    df = df.drop_duplicates(subset=[unique])    
-                write_pandas(conn, df, table_name.upper())
-            elif operation=='insert':
-                if unique:
-                    assert unique in df.columns, f'"{unique}" is not in the dataframe columns'
-                    df = df.drop_duplicates(subset=[unique])
-
-                table_rows = str(list(df.itertuples(index=False, name=None))).replace('[','').replace(']','')
-
-                if unique:
-                    cols = df.columns
-                    temp_table = f't('
-                    for c in cols:
-                        temp_table+=c+','
-                    temp_table = temp_table[:-1] + ')'                        
-                    sql_statement = f"""
-                        INSERT INTO {table_name}
-                        SELECT *
-                        FROM (VALUES
-                            {table_rows}
-                        ) AS {temp_table}
-                        -- Make sure the table doesn't already contain the IDs we're trying to insert
-                        WHERE {unique} NOT IN (
-                        SELECT {unique} FROM {table_name}
-                        )
-                        -- Make sure the data we're inserting doesn't contain duplicate IDs
-                        -- If it does, only the first record will be inserted (based on the ORDER BY)
-                        -- Ideally, we would want to order by a timestamp to select the latest record
-                        QUALIFY ROW_NUMBER() OVER (
-                        PARTITION BY {unique}
-                        ORDER BY {unique} ASC
-                        ) = 1;
-                    """                    
-                else:
-                    sql_statement = f"INSERT INTO {table_name} VALUES {table_rows}"
-                conn.cursor().execute(sql_statement)
-
-        operation = 'create_replace'
-        if append==True:
-            operation = 'insert'
-
-        df_to_snowflake_table(table, operation, df, conn=conn, unique=unique, **kwargs)
-
-        # success, nchunks, nrows, output  = write_pandas(conn=conn,df=self.df,table_name=table,database=database,schema=schema,overwrite=True,quote_identifiers=False,auto_create_table=True)
+                conn.cursor().execute(f"CREATE OR REPLACE TABLE {table} ({table_metadata})")
+            stage_to_snowflake(conn, table, batches, unique=unique, parallel=parallel)
 
 class Test(Query):
     """
     DQT Test Class
 
-    Use this class to test data using SQL templates, ala DBT
+    Use this class to test data using SQL templates, ala DBT.  A test template selects the records which fail
+    the test, so the test passes if it returns no rows.
 
     Test templates live in workspace/tests/sql
     """
-    def __init__(self, template=''):
-        super().__init__(query=template)
+    def __init__(self, template='', **kwargs):
         assert template[-4:]=='.sql', "you need to input a '.sql' template file"
-        assert self.template[:5]=='test_', "your test template needs to start with 'test_'"
-        super().__init__(query=template)
+        assert os.path.basename(template)[:5]=='test_', "your test template needs to start with 'test_'"
+        super().__init__(query=template, **kwargs)
+        self.test_result=None
+        self.fails=None
 
     def run(self):
+        """
+        runs the test, fetching every failing record into self.test_details
+        """
         self.test_result='FAILED'
         try:
             super().run()
             self.test_details=self.df
+            self.fails=len(self.df)
         except NoDataException:
             self.test_result='PASSED'        
+            self.fails=0
         
         return self.test_result
+
+    def check(self, mode='exists', database='', schema=''):
+        """
+        runs the test without downloading the failing records:
+
+        mode='exists' - only checks whether any record fails (the test's sql is wrapped in a LIMIT 1 query)
+        mode='count' - also counts the failing records (into self.fails)
+        """
+        assert mode in ['exists','count'], "mode must be 'exists' or 'count'"
+        sql = self.sql.text.strip().rstrip(';')
+        if mode=='exists':
+            sql = f"SELECT 1 AS failed FROM (\n{sql}\n) AS dqt_test LIMIT 1"
+        else:
+            sql = f"SELECT COUNT(*) AS fails FROM (\n{sql}\n) AS dqt_test"
+        table = self._fetch_arrow(sql, database=database or get_database(), schema=schema or get_schema())
+        if mode=='exists':
+            self.fails = None
+            failed = table.num_rows>0
+        else:
+            self.fails = int(table.column(0)[0].as_py())
+            failed = self.fails>0
+        self.test_result = 'FAILED' if failed else 'PASSED'
+        return self.test_result
+
+class TestSuite:
+    """
+    Runs sql test templates (see Test) concurrently; by default every test_*.sql in workspace/tests/sql.
+
+     - mode='exists' (default) only checks whether each test has any failing record, 'count' counts them and
+       'full' downloads them (as Test.run does)
+     - with details=True, failing records are then fetched for the failing tests only, into .failed_records
+     - a test which errors is reported as 'ERROR' and does not stop the others
+
+        suite = TestSuite().run()
+        suite.report   # {'passed': n, 'failed': n, 'errors': n, 'seconds': s, 'tests': [{...}, ...]}
+        suite.to_json()
+    """
+    def __init__(self, tests=None, mode='exists', details=False, max_workers=8, **kwargs):
+        assert mode in ['exists','count','full'], "mode must be 'exists', 'count' or 'full'"
+        if tests is None:
+            test_dir = get_user_tests_template_dir()
+            tests = sorted(f for f in os.listdir(test_dir) if f.startswith('test_') and f.endswith('.sql'))
+        self.tests = list(tests)
+        self.mode = mode
+        self.details = details
+        self.max_workers = max_workers
+        self.params = kwargs
+        self.report = None
+        self.failed_records = {}
+
+    def __repr__(self):
+        if self.report is None:
+            return f'TestSuite(tests={len(self.tests)}, mode={self.mode!r})'
+        return f"TestSuite(tests={len(self.tests)}, passed={self.report['passed']}, failed={self.report['failed']}, errors={self.report['errors']})"
+
+    def _run_one(self, template):
+        start = time.perf_counter()
+        result = {'name': template, 'result': 'ERROR', 'fails': None, 'seconds': None, 'error': None}
+        try:
+            test = Test(template, **self.params)
+            if self.mode=='full':
+                test.run()
+                if test.test_result=='FAILED':
+                    self.failed_records[template] = test.test_details
+            else:
+                test.check(mode=self.mode)
+                if test.test_result=='FAILED' and self.details:
+                    test.run()
+                    self.failed_records[template] = test.test_details
+            result['result'] = test.test_result
+            result['fails'] = test.fails
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run(self):
+        """
+        runs every test and returns self; results are in .report (and failing records, if fetched, in .failed_records)
+        """
+        start = time.perf_counter()
+        self.failed_records = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._run_one, self.tests))
+        self.report = {
+            'passed': sum(r['result']=='PASSED' for r in results),
+            'failed': sum(r['result']=='FAILED' for r in results),
+            'errors': sum(r['result']=='ERROR' for r in results),
+            'seconds': round(time.perf_counter() - start, 3),
+            'tests': results,
+        }
+        return self
+
+    def to_json(self, **kwargs):
+        """
+        returns the report as a json string
+        """
+        assert self.report is not None, "run the suite first - TestSuite.run()"
+        return json.dumps(self.report, **kwargs)
     
+class QueryBatch:
+    """
+    Runs many Query objects concurrently on a thread pool.
+
+     - queries already cached (with synced sql) are loaded from the cache and never hit the network
+     - queries whose compiled sql is identical are only run once and share the result
+     - at most max_per_warehouse queries run at once on any one warehouse (an int, or a dict of
+       {warehouse: limit} with a 'default' key); local (duckdb) queries count against 'duckdb'
+     - a failing query does not stop the others; its exception is collected in .errors
+
+    Use run_many() as a shortcut:
+
+        batch = run_many([Query('sales.sql', region=r) for r in regions])
+        batch.results  # list of dataframes (None where the query failed)
+        batch.errors   # {index of query: exception}
+    """
+    def __init__(self, queries, max_workers=8, max_per_warehouse=4):
+        self.queries = list(queries)
+        self.max_workers = max_workers
+        self.max_per_warehouse = max_per_warehouse
+        self.errors = {}
+        self.cached = []
+        self._limits = {}
+        self._limits_lock = threading.Lock()
+
+    def __repr__(self):
+        n_ok = len(self.queries) - len(self.errors)
+        return f'QueryBatch(queries={len(self.queries)}, succeeded={n_ok}, from_cache={len(self.cached)}, errors={len(self.errors)})'
+
+    @property
+    def results(self):
+        return [q.df if i not in self.errors else None for i, q in enumerate(self.queries)]
+
+    def load(self):
+        """
+        loads every query from cache if present, otherwise runs it (cf. Query.load)
+        """
+        return self._execute(refresh=False)
+
+    def run(self):
+        """
+        runs every query, ignoring any cached results (cf. Query.run)
+        """
+        return self._execute(refresh=True)
+
+    def _limit(self, warehouse):
+        with self._limits_lock:
+            if warehouse not in self._limits:
+                limit = self.max_per_warehouse
+                if isinstance(limit, dict):
+                    limit = limit.get(warehouse, limit.get('default', self.max_workers))
+                self._limits[warehouse] = threading.BoundedSemaphore(limit)
+            return self._limits[warehouse]
+
+    def _run_one(self, query):
+        warehouse = 'duckdb' if query.engine=='duckdb' else get_warehouse()
+        with self._limit(warehouse):
+            return query.run()
+
+    def _execute(self, refresh):
+        self.errors = {}
+        self.cached = []
+        groups = OrderedDict()
+        for i, query in enumerate(self.queries):
+            if not refresh and query.is_cached() and query.cache_is_synced():
+                self.cached.append(i)
+            else:
+                groups.setdefault(query.get_cache_key(), []).append(i)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for i in self.cached:
+                futures[executor.submit(self.queries[i].load)] = [i]
+            for indices in groups.values():
+                futures[executor.submit(self._run_one, self.queries[indices[0]])] = indices
+            for future in as_completed(futures):
+                indices = futures[future]
+                try:
+                    df = future.result()
+                except Exception as e:
+                    for i in indices:
+                        self.errors[i] = e
+                    continue
+                # every query in a group shares one cache entry, so it only needs writing once
+                leader = self.queries[indices[0]]
+                cached_file = leader.csv if leader.cache else None
+                for i in indices[1:]:
+                    query = self.queries[i]
+                    query.df = df
+                    if not query.cache:
+                        continue
+                    try:
+                        if cached_file is None:
+                            query.write_cache(df)
+                            cached_file = query.csv
+                        else:
+                            query.csv = cached_file
+                    except Exception as e:
+                        self.errors[i] = e
+        return self
+
+def run_many(queries, max_workers=8, max_per_warehouse=4, refresh=False):
+    """
+    loads (or, if refresh is True, runs) many Query objects concurrently and returns the QueryBatch
+    """
+    batch = QueryBatch(queries, max_workers=max_workers, max_per_warehouse=max_per_warehouse)
+    if refresh:
+        return batch.run()
+    return batch.load()
+
+def split_grouping_sets(df, dims, id_column='grouping_id'):
+    """
+    splits the result of a grouping sets query (see the grouping_sets and grouping_id macros) back into one dataframe
+    per combination of dims, returning {tuple of dims grouped by: dataframe}, eg:
+
+        frames = split_grouping_sets(q.df, ['region','source'])
+        frames[('region',)]  # aggregates by region
+
+    column names are matched case-insensitively (snowflake returns them upper case)
+    """
+    columns = {c.upper(): c for c in df.columns}
+    dims = [columns[d.upper()] for d in dims]
+    id_column = columns[id_column.upper()]
+    n = len(dims)
+    frames = {}
+    for grouping_id, frame in df.groupby(id_column, sort=False):
+        grouped_by = tuple(d for i, d in enumerate(dims) if not (int(grouping_id) >> (n - 1 - i)) & 1)
+        dropped = [id_column] + [d for d in dims if d not in grouped_by]
+        frames[grouped_by] = frame.drop(columns=dropped).reset_index(drop=True)
+    return dict(sorted(frames.items(), key=lambda item: (len(item[0]), [dims.index(d) for d in item[0]])))
+
 def get_global_template_dir():
     return os.path.join(str(Path(__file__).parents[0]),'sql/templates/')
 def get_global_macros_dir():
@@ -913,26 +2604,200 @@ def get_user_includes_dir():
     return os.path.join(ws_root,ws_name,'templates/includes')
     # return os.path.join(USER_DIR,'templates/includes/')
 
+def get_template_search_path():
+    """
+    returns the list of dirs (user then global) that jinja searches for templates, macros and includes
+    """
+    return list(_search_path(get_ws()))
+
+@functools.lru_cache(maxsize=16)
+def _search_path(ws):
+    ws_root, ws_name = ws
+    return (
+        os.path.join(ws_root,ws_name,'templates'),
+        os.path.join(ws_root,ws_name,'tests','sql'),
+        get_global_template_dir(),
+        os.path.join(ws_root,ws_name,'templates/macros'),
+        get_global_macros_dir(),
+        os.path.join(ws_root,ws_name,'templates/includes'),
+        # get_global_includes_dir()
+    )
+
+def get_jinja_cache_dir():
+    ws_root, ws_name = get_ws()
+    return os.path.join(ws_root,ws_name,'cache/jinja')
+
+def get_environment(search_path=None):
+    """
+    returns the jinja Environment for the current workspace, creating it on first use.
+
+    The environment is reused across compiles; it keeps parsed templates in memory (reloading any whose file
+    mtime has changed) and compiled template bytecode in the workspace's cache/jinja dir.
+    """
+    if search_path is None:
+        search_path = get_template_search_path()
+    search_path = tuple(search_path)
+    with _RENDER_LOCK:
+        environment = _ENVIRONMENTS.get(search_path)
+        if environment is None:
+            os.makedirs(get_jinja_cache_dir(), exist_ok=True)
+            environment = Environment(
+                loader=FileSystemLoader(list(search_path)),
+                bytecode_cache=FileSystemBytecodeCache(get_jinja_cache_dir()),
+                auto_reload=True,
+            )
+            custom_filters = [f for _, f in filters.__dict__.items() if callable(f)]
+            custom_filters = [f for f in custom_filters if f.__name__[:4]=='dqt_']
+            for f in custom_filters:
+                environment.filters[f.__name__] = f
+            _ENVIRONMENTS[search_path] = environment
+    return environment
+
+@functools.lru_cache(maxsize=1024)
+def _referenced_templates(environment, source):
+    """
+    returns the names of the templates that source imports, includes or extends (None if any name is dynamic)
+    """
+    names = tuple(meta.find_referenced_templates(environment.parse(source)))
+    return None if None in names else names
+
+def _template_dependencies(environment, names):
+    """
+    returns ((path, mtime_ns), ...) for the templates named and everything they reference, resolved along the
+    search path; paths searched before the one found are recorded with mtime None, so adding a template which
+    shadows a dependency also changes the result.  Returns None if a dependency can't be determined.
+    """
+    stamps, seen, pending = [], set(), list(names)
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        for root in environment.loader.searchpath:
+            path = os.path.join(root, *name.split('/'))
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                stamps.append((path, None))
+                continue
+            stamps.append((path, mtime))
+            with open(path, encoding=environment.loader.encoding) as f:
+                referenced = _referenced_templates(environment, f.read())
+            if referenced is None:
+                return None
+            pending.extend(referenced)
+            break
+    return tuple(stamps)
+
+def _dependencies_unchanged(stamps):
+    for path, mtime in stamps:
+        try:
+            current = os.stat(path).st_mtime_ns
+        except OSError:
+            current = None
+        if current!=mtime:
+            return False
+    return True
+
 def compile(template='total_aggs.sql',*args,**kwargs):
     """
     creates sql queries by injecting into template
     or takes a string query and substitues params
+
+    Rendered sql is memoized on (template, params) and reused while the template and the macros / includes it
+    references are unchanged (only those files are stat'ed), so compiling the same query twice is cheap.
     """
+    search_path = _search_path(get_ws())
+    key = (
+        search_path,
+        template,
+        args,
+        json.dumps(kwargs, sort_keys=True, default=repr),
+    )
+    with _RENDER_LOCK:
+        memo = _RENDERED_SQL.get(key)
+        if memo is not None:
+            _RENDERED_SQL.move_to_end(key)
+
+    if memo is not None and _dependencies_unchanged(memo[1]):
+        result = memo[0]
+    else:
+        result, stamps = _render(get_environment(search_path), template, *args, **kwargs)
+        if stamps is not None:
+            with _RENDER_LOCK:
+                _RENDERED_SQL[key] = (result, stamps)
+                while len(_RENDERED_SQL) > RENDER_CACHE_SIZE:
+                    _RENDERED_SQL.popitem(last=False)
 
-    environment = Environment(loader=FileSystemLoader([
-        get_user_template_dir(),
-        get_user_tests_template_dir(),
-        get_global_template_dir(),
-        get_user_macros_dir(),
-        get_global_macros_dir(),
-        get_user_includes_dir()
-        # get_global_includes_dir()
-    ]))
-    custom_filters = [f for _, f in filters.__dict__.items() if callable(f)]
-    custom_filters = [f for f in custom_filters if f.__name__[:4]=='dqt_']
-    for f in custom_filters:
-        # environment.filters['dqt_combinations'] = filters.dqt_combinations
-       environment.filters[f.__name__] = f
+    # local sources are resolved per call, as csv ingest depends on the files' current state
+    is_template, rendered_str = result
+    sql = rewrite_local_sources(rendered_str)
+    return result if sql is rendered_str else (is_template, sql)
+
+_CSV_SOURCE = re.compile(r"'[A-Za-z0-9_./]+\.csv'")
+
+def rewrite_local_sources(sql):
+    """
+    points any quoted '.csv' files referenced in sql at duckdb readers; read_csv_auto(...) or, if csv ingest
+    is on (see set_csv_ingest), read_parquet(...) of the file's columnar copy
+    """
+    for m in dict.fromkeys(_CSV_SOURCE.findall(sql)):
+        csv_file = m[1:-1]
+        if CACHE_SETTINGS['INGEST_CSV'] and os.path.exists(csv_file):
+            sql = sql.replace(m, f"read_parquet({_quote(ingest_csv(csv_file))})")
+        else:
+            sql = sql.replace(m, f'read_csv_auto({m}, header=true)')
+    return sql
+
+def is_local_sql(sql):
+    """
+    returns True if sql reads local data files (and so runs on duckdb)
+    """
+    return ('.csv' in sql) or ('read_parquet(' in sql)
+
+def get_ingest_dir():
+    ws_root, ws_name = get_ws()
+    return os.path.join(ws_root,ws_name,'cache/ingest')
+
+def ingest_csv(csv_file):
+    """
+    converts csv_file (once) into a zstd compressed parquet copy in the workspace's cache/ingest dir and
+    returns the parquet file's location.  Copies are keyed by the csv's path, size and mtime, so a changed
+    csv is re-ingested (and its stale copy removed) the next time it is used.
+    """
+    csv_file = os.path.abspath(csv_file)
+    stat = os.stat(csv_file)
+    stem = re.sub(r'\W+', '_', os.path.basename(csv_file)[:-4].lower())
+    path_hash = hashlib.sha256(csv_file.encode('utf-8')).hexdigest()[:8]
+    version_hash = hashlib.sha256(f'{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')).hexdigest()[:8]
+    ingest_dir = get_ingest_dir()
+    prefix = f'{stem}_{path_hash}_'
+    parquet_file = os.path.join(ingest_dir, f'{prefix}{version_hash}.parquet')
+    if os.path.exists(parquet_file):
+        return parquet_file
+
+    import duckdb
+    os.makedirs(ingest_dir, exist_ok=True)
+    temp_file = f'{parquet_file}.{uuid.uuid4()}.tmp'
+    con = duckdb.connect()
+    try:
+        con.execute(
+            f"COPY (SELECT * FROM read_csv_auto({_quote(csv_file)}, header=true)) "
+            f"TO {_quote(temp_file)} (FORMAT PARQUET, COMPRESSION ZSTD)"
+        )
+    finally:
+        con.close()
+    os.replace(temp_file, parquet_file)
+    for f in os.listdir(ingest_dir):
+        if f.startswith(prefix) and f.endswith('.parquet') and f!=os.path.basename(parquet_file):
+            os.remove(os.path.join(ingest_dir, f))
+    return parquet_file
+
+def _render(environment, template, *args, **kwargs):
+    """
+    renders template (a template file name or sql string) with environment, returning ((is_template, sql), stamps)
+    where stamps are the template files it depends on (see _template_dependencies)
+    """
 
     if 'select' in template.lower():
         s=template
@@ -944,37 +2809,23 @@ def compile(template='total_aggs.sql',*args,**kwargs):
         r=re.search(pattern,s)
 
         if ('{%' in s) or (r!=None):
-            filename = str(uuid.uuid4()) + '.sql'
-            full_filename = os.path.join(get_user_template_dir(),filename) 
             if (r!=None):
                 s = "{% import 'macros.jinja' as macros %}\n" + s
                 s = "{% import 'mymacros.jinja' as mymacros %}\n" + s
 
-            with open(full_filename, 'w+') as f:
-                f.write(s)
-            template = environment.get_template(filename)
-            os.remove(full_filename)
+            # compiled in memory; imports, includes and extends still resolve via the workspace loader
+            template = _string_template(environment, s)
+            referenced = _referenced_templates(environment, s)
+            stamps = None if referenced is None else _template_dependencies(environment, referenced)
 
             rendered_str = template.render(kwargs)
-            pattern = '\'[A-Za-z0-9_.-\/]+\.csv\''
-            m=re.findall(pattern, rendered_str)
-            if len(m)>0:
-                rendered_str=rendered_str.replace(m[0],f'read_csv_auto({m[0]}, header=true)')    
-            return (False,rendered_str)
+            return (False,rendered_str), stamps
         else:
             for key,val in kwargs.items():
                 s=s.replace('{{' + key + '}}',val)
             rendered_str=s                
-            pattern = '\'[A-Za-z0-9_.-\/]+\.csv\''
-            m=re.findall(pattern, rendered_str)
-            if len(m)>0:
-                rendered_str=rendered_str.replace(m[0],f'read_csv_auto({m[0]}, header=true)')    
-            return (False,rendered_str)            
+            return (False,rendered_str), ()
     else:
-        template = environment.get_template(template)
-        rendered_str = template.render(kwargs)
-        pattern = '\'[A-Za-z0-9_.-\/]+\.csv\''
-        m=re.findall(pattern, rendered_str)
-        if len(m)>0:
-            rendered_str=rendered_str.replace(m[0],f'read_csv_auto({m[0]}, header=true)')    
-        return (True,rendered_str)
\ No newline at end of file
+        stamps = _template_dependencies(environment, [template])
+        rendered_str = environment.get_template(template).render(kwargs)
+        return (True,rendered_str), stamps
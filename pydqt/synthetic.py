@@ -0,0 +1,129 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+REGIONS = ['US','GB','DE','IT','ES','FR']
+SOURCES = ['css','direct','organic','app']
+FORMATS = ['csv', 'parquet', 'duckdb']
+
+
+def _dimensions(dims, cardinality):
+    """
+    returns {column name: pyarrow array of its values}; dims is either a number of dimensions (named dim_1, dim_2,
+    ... with values like 'dim_1_0') or a dict of {name: list of values or a cardinality}
+    """
+    if dims is None:
+        dims = {'region': REGIONS, 'source': SOURCES}
+    if isinstance(dims, int):
+        cardinalities = cardinality if isinstance(cardinality, (list, tuple)) else [cardinality]*dims
+        assert len(cardinalities)==dims, "cardinality must be an int or a list with one value per dimension"
+        dims = {f'dim_{i+1}': n for i, n in enumerate(cardinalities)}
+    values = {}
+    for name, levels in dims.items():
+        if isinstance(levels, int):
+            levels = [f'{name}_{i}' for i in range(levels)]
+        assert len(levels)>0, f"dimension {name} has no values"
+        values[name] = pa.array(levels)
+    return values
+
+
+def _chunk(offset, rows, dates, dimensions, seed, chunk_index, grid):
+    """
+    generates one chunk of rows as a pyarrow table.  Each chunk has its own random stream, seeded by (seed, chunk
+    index), so a chunk can be generated without generating the ones before it.
+    """
+    rng = np.random.default_rng([seed, chunk_index])
+    columns = {}
+    if grid:
+        # row number -> (dims..., date) in row-major order, so rows enumerate every combination (dates fastest)
+        index = np.arange(offset, offset + rows, dtype=np.int64)
+        columns['dates'] = dates.take(pa.array(index % len(dates)))
+        index //= len(dates)
+        positions = {}
+        for name in reversed(list(dimensions)):
+            positions[name] = index % len(dimensions[name])
+            index //= len(dimensions[name])
+    else:
+        columns['dates'] = dates.take(pa.array(rng.integers(0, len(dates), rows)))
+        positions = {name: rng.integers(0, len(levels), rows) for name, levels in dimensions.items()}
+    orders = np.floor(100*rng.random(rows)).astype(np.int64)
+    columns['orders'] = pa.array(orders)
+    columns['gmv'] = pa.array(np.round(100*orders*rng.random(rows), 2))
+    for name, levels in dimensions.items():
+        columns[name] = levels.take(pa.array(positions[name]))
+    return pa.table(columns)
+
+
+def generate_data(rows, path=None, fmt=None, dims=None, cardinality=10, start='2022-01-01', end=None, periods=365,
+                  freq='D', seed=0, grid=False, chunk_size=1_000_000, table='synthetic'):
+    """
+    generates rows of seeded synthetic orders data with columns dates, orders, gmv and one column per dimension,
+    chunk_size rows at a time, so it scales to hundreds of millions of rows without holding them all in memory.
+
+     - dims: a number of dimensions (named dim_1, dim_2, ..., each with cardinality distinct values; cardinality can
+       also be a list with one value per dimension) or a dict of {name: list of values or a cardinality}.  Defaults
+       to region and source, like test.csv.
+     - start, end, periods, freq: the date span, as for pd.date_range (dates are stored as dates)
+     - seed: the same seed, rows and chunk_size always generate the same data
+     - grid: if True, rows enumerate every combination of dimensions and dates in order (wrapping round) rather than
+       sampling them at random
+     - path, fmt: where and how to write the data; fmt is 'csv', 'parquet' or 'duckdb' (inferred from path's
+       extension if not given).  For 'duckdb', path is a duckdb database file (or an open duckdb connection) and the
+       data is written to table.  If path is None the data is returned as a pandas dataframe.
+
+    returns path (or the dataframe, if path is None)
+    """
+    assert rows>=0, "rows must be non-negative"
+    assert chunk_size>0, "chunk_size must be positive"
+    if fmt is None and isinstance(path, str):
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {'.csv': 'csv', '.duckdb': 'duckdb', '.db': 'duckdb'}.get(ext, 'parquet')
+    assert path is None or fmt in FORMATS, f"fmt must be one of {FORMATS}"
+    dates = pa.array(pd.date_range(start=start, end=end, periods=None if end else periods, freq=freq).date, pa.date32())
+    assert len(dates)>0, "the date span has no dates"
+    dimensions = _dimensions(dims, cardinality)
+
+    chunks = (
+        _chunk(offset, min(chunk_size, rows - offset), dates, dimensions, seed, i, grid)
+        for i, offset in enumerate(range(0, rows, chunk_size))
+    )
+    if path is None:
+        tables = list(chunks) or [_chunk(0, 0, dates, dimensions, seed, 0, grid)]
+        return pa.concat_tables(tables).to_pandas(date_as_object=False)
+
+    schema = _chunk(0, 0, dates, dimensions, seed, 0, grid).schema
+    if fmt=='duckdb':
+        _write_duckdb(path, table, schema, chunks)
+        return path
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    if fmt=='csv':
+        import pyarrow.csv as csv
+        writer = csv.CSVWriter(tmp_file, schema, write_options=csv.WriteOptions(quoting_style='needed'))
+    else:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(tmp_file, schema, compression='zstd')
+    try:
+        with writer:
+            for chunk in chunks:
+                writer.write_table(chunk)
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return path
+
+
+def _write_duckdb(path, table, schema, chunks):
+    import duckdb
+    con = duckdb.connect(path) if isinstance(path, str) else path
+    try:
+        con.execute(f'DROP TABLE IF EXISTS {table}')
+        con.from_arrow(schema.empty_table()).create(table)
+        for chunk in chunks:
+            con.from_arrow(chunk).insert_into(table)
+    finally:
+        if isinstance(path, str):
+            con.close()
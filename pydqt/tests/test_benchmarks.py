@@ -0,0 +1,33 @@
+import json
+import os
+
+from pydqt import benchmarks
+
+
+def test_benchmarks_run_and_compare(tmp_path):
+    """
+    tests that the benchmark suite runs offline on a small dataset, leaves the workspace alone and that results saved
+    as json can be compared
+    """
+    workspace = (os.environ.get('WORKSPACE_ROOT'), os.environ.get('WORKSPACE_NAME'))
+    results = benchmarks.run_benchmarks(sizes=[10000], repeat=1)
+    assert (os.environ.get('WORKSPACE_ROOT'), os.environ.get('WORKSPACE_NAME'))==workspace
+
+    names = {r['name'] for r in results['results']}
+    assert {'query_construction', 'render_macros', 'cache_read_parquet', 'cache_write_feather', 'data_tests', 'local_aggregation'} <= names
+    assert all(r['median']>0 for r in results['results'])
+    assert results['meta']['sizes']==[10000]
+
+    out = tmp_path / 'results.json'
+    out.write_text(json.dumps(results))
+    comparison = benchmarks.compare(str(out), results)
+    assert len(comparison)==len(results['results'])
+    assert all(r['ratio']==1 for r in comparison)
+
+
+def test_benchmarks_only():
+    """
+    tests that only the requested benchmarks are run
+    """
+    results = benchmarks.run_benchmarks(sizes=[1000], repeat=1, only=['local_aggregation'])
+    assert [(r['name'], r['rows']) for r in results['results']]==[('local_aggregation', 1000)]
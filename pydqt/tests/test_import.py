@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import sys
+
+
+IMPORT_CHECK = """
+import builtins, json, os, sys, time
+
+writes = []
+_open, _mkdir, _makedirs = builtins.open, os.mkdir, os.makedirs
+def record_open(file, mode='r', *args, **kwargs):
+    if any(c in mode for c in 'wax+'):
+        writes.append(str(file))
+    return _open(file, mode, *args, **kwargs)
+builtins.open = record_open
+os.mkdir = lambda path, *args, **kwargs: writes.append(str(path))
+os.makedirs = lambda path, *args, **kwargs: writes.append(str(path))
+
+import pandas, numpy, pyarrow, pyarrow.parquet, pyarrow.feather, jinja2, dotenv
+start = time.perf_counter()
+import pydqt
+seconds = time.perf_counter() - start
+
+print(json.dumps({
+    'seconds': seconds,
+    'writes': writes,
+    'engines': [m for m in ['snowflake.connector', 'duckdb', 'sqlparse'] if m in sys.modules],
+}))
+"""
+
+# budget for pydqt's own import time, on top of pandas / pyarrow / jinja2 which it always needs
+IMPORT_BUDGET_SECONDS = 0.5
+
+
+def test_import_is_fast_and_side_effect_free():
+    """
+    tests that importing pydqt doesn't import the database engines, doesn't write any files and is quick
+    """
+    out = subprocess.run([sys.executable, '-c', IMPORT_CHECK], capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result['engines']==[]
+    assert result['writes']==[]
+    assert result['seconds']<IMPORT_BUDGET_SECONDS
+
+
+ENV_CHECK = """
+import json, os
+import pydqt.pydqt as dqt
+os.environ['WORKSPACE_NAME'] = 'set_after_import'
+os.environ['SNOWFLAKE_PASSWORD'] = 'set_after_import'
+print(json.dumps({'name': dqt.get_ws()[1], 'password': os.environ['SNOWFLAKE_PASSWORD']}))
+"""
+
+
+def test_first_use_keeps_environment_variables_set_after_import(tmp_path):
+    """
+    tests that the setup run on first use doesn't reload the .env over environment variables set after import
+    """
+    env = dict(os.environ, WORKSPACE_ROOT=str(tmp_path))
+    out = subprocess.run([sys.executable, '-c', ENV_CHECK], capture_output=True, text=True, check=True, env=env)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result=={'name': 'set_after_import', 'password': 'set_after_import'}
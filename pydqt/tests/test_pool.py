@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from pydqt.pool import ConnectionPool, PoolExhaustedException
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        conn.open_cursors += 1
+
+    def execute(self, sql):
+        if self.conn.broken:
+            raise Exception('connection lost')
+        self.conn.pings += 1
+
+    def close(self):
+        self.conn.open_cursors -= 1
+
+
+class FakeConnection:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.closed = False
+        self.broken = False
+        self.pings = 0
+        self.open_cursors = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_reuses_connections_per_key():
+    """
+    tests that a released connection is handed out again for the same key, but not for a different key
+    """
+    pool = ConnectionPool(connect=FakeConnection)
+    with pool.checkout(('wh', 'db', 'a', 'role'), schema='a') as conn:
+        pass
+    with pool.checkout(('wh', 'db', 'a', 'role'), schema='a') as conn_again:
+        assert conn_again is conn
+    with pool.checkout(('wh', 'db', 'b', 'role'), schema='b') as conn_other:
+        assert conn_other is not conn
+        assert conn_other.kwargs=={'schema': 'b'}
+
+
+def test_pool_discards_closed_and_unhealthy_connections():
+    """
+    tests that closed connections are dropped and stale connections are pinged (closing the cursor) before reuse
+    """
+    pool = ConnectionPool(connect=FakeConnection, ping_after=0)
+    with pool.checkout('key') as conn:
+        pass
+    with pool.checkout('key') as conn_again:
+        assert conn_again is conn
+    assert conn.pings==1 and conn.open_cursors==0
+    conn.broken = True
+    with pool.checkout('key') as conn_new:
+        assert conn_new is not conn
+        assert conn.closed
+    conn_new.close()
+    with pool.checkout('key') as conn_newer:
+        assert conn_newer is not conn_new
+
+
+def test_pool_evicts_idle_connections():
+    """
+    tests that connections idle for longer than max_idle are closed
+    """
+    pool = ConnectionPool(connect=FakeConnection, max_idle=0)
+    with pool.checkout('key') as conn:
+        pass
+    time.sleep(0.01)
+    with pool.checkout('key') as conn_new:
+        assert conn_new is not conn
+    assert conn.closed
+
+
+def test_pool_blocks_at_max_size():
+    """
+    tests that checkouts beyond max_size wait for a connection to be released (or time out)
+    """
+    pool = ConnectionPool(connect=FakeConnection, max_size=1, timeout=0.05)
+    conn = pool.acquire('key')
+    with pytest.raises(PoolExhaustedException):
+        pool.acquire('key')
+
+    threading.Timer(0.01, pool.release, args=('key', conn)).start()
+    pool.timeout = 5
+    assert pool.acquire('key') is conn
+
+
+def test_pool_close_all():
+    """
+    tests that close_all closes idle connections
+    """
+    pool = ConnectionPool(connect=FakeConnection)
+    with pool.checkout('a') as conn_a, pool.checkout('b') as conn_b:
+        pass
+    pool.close_all()
+    assert conn_a.closed and conn_b.closed
+    assert pool.stats()['a']=={'idle': 0, 'in_use': 0}
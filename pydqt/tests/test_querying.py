@@ -5,6 +5,9 @@ from pydqt.pydqt import test_data_file_full_path as full_path_test_data_file
 from pydqt.pydqt import get_user_template_dir, get_user_includes_dir, get_user_macros_dir
 import pydqt.pydqt as dqt
 import os
+import json
+import contextlib
+import time
 
 import shutil
 from pathlib import Path
@@ -12,6 +15,7 @@ import pandas as pd
 import sqlparse
 import pytest
 import numpy as np
+import pyarrow as pa
 
 ########################################################################################################################
 ####  some set up - create temp template with {{table}} variable, where table = 'lyst_analytics.union_touch_points' ####
@@ -192,3 +196,742 @@ def test_change_of_workspace():
     # print(user_dir)
     assert user_dir==f'{root}/{name}/templates'
 
+
+def test_cache_data_roundtrip_keeps_dtypes(tmp_path):
+    """
+    tests that parquet and feather caches round-trip the dataframe with its dtypes (eg dates stay dates)
+    """
+    df = pd.read_csv(full_path_test_data_file(), parse_dates=['dates'])
+    for fmt in ['parquet', 'feather']:
+        filename = dqt.write_cache_data(df, str(tmp_path), fmt=fmt)
+        assert os.path.basename(filename)==dqt.CACHE_FORMATS[fmt]
+        df_cached = dqt.read_cache_data(filename)
+        pd.testing.assert_frame_equal(df, df_cached)
+
+def test_cache_data_legacy_csv_uses_schema(tmp_path):
+    """
+    tests that legacy data.csv caches are still readable and get their dtypes back from schema.json
+    """
+    df = pd.read_csv(full_path_test_data_file(), parse_dates=['dates'])
+    dqt.write_cache_data(df, str(tmp_path), fmt='parquet')
+    os.remove(os.path.join(tmp_path, 'data.parquet'))
+    df.to_csv(os.path.join(tmp_path, 'data.csv'), index=False)
+    df_cached = dqt.read_cache_data(os.path.join(tmp_path, 'data.csv'))
+    assert str(df_cached['dates'].dtype).startswith('datetime64')
+
+def test_compile_is_memoized_and_sees_template_edits():
+    """
+    tests that compile reuses rendered sql for identical calls but re-renders when a template is edited
+    """
+    set_temp_workspace()
+    template_file = os.path.join(get_user_template_dir(), 'delme_memo.sql')
+    with open(template_file, 'w') as f:
+        f.write("select {{col}} from '{{table}}'")
+    first = dqt.compile('delme_memo.sql', col='orders', table='t')
+    assert dqt.compile('delme_memo.sql', col='orders', table='t') is first
+    assert dqt.get_environment() is dqt.get_environment()
+
+    with open(template_file, 'w') as f:
+        f.write("select {{col}}, gmv from '{{table}}'")
+    stat = os.stat(template_file)
+    os.utime(template_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert 'gmv' in dqt.compile('delme_memo.sql', col='orders', table='t')[1]
+
+def test_compile_memo_only_checks_the_templates_it_uses(monkeypatch):
+    """
+    tests that a memoized compile doesn't walk the template dirs, but still sees edits to an imported macro file
+    """
+    set_temp_workspace()
+    macro_file = os.path.join(get_user_macros_dir(), 'delme_macros.jinja')
+    with open(macro_file, 'w') as f:
+        f.write("{% macro col() %}orders{% endmacro %}")
+    with open(os.path.join(get_user_template_dir(), 'delme_memo_import.sql'), 'w') as f:
+        f.write("{% import 'delme_macros.jinja' as m %}select {{ m.col() }} from '{{table}}'")
+    first = dqt.compile('delme_memo_import.sql', table='t')
+    assert 'orders' in first[1]
+
+    def walk(*args, **kwargs):
+        raise AssertionError('compile walked the template dirs')
+    monkeypatch.setattr(os, 'walk', walk)
+    assert dqt.compile('delme_memo_import.sql', table='t') is first
+
+    with open(macro_file, 'w') as f:
+        f.write("{% macro col() %}gmv{% endmacro %}")
+    stat = os.stat(macro_file)
+    os.utime(macro_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert 'gmv' in dqt.compile('delme_memo_import.sql', table='t')[1]
+
+def test_string_template_compiles_without_writing_files():
+    """
+    tests that string queries using jinja tags or macros are rendered in memory (no temp files in the workspace)
+    """
+    set_temp_workspace()
+    before = sorted(os.listdir(get_user_template_dir()))
+    is_template, sql = dqt.compile(
+        "select {% if col %}{{col}}{% endif %}, {{macros.movsum('gmv',3,order='dates')}} from '{{table}}'",
+        col='orders', table='t'
+    )
+    assert not is_template
+    assert 'sum(gmv)' in sql
+    assert sorted(os.listdir(get_user_template_dir()))==before
+
+def test_iter_batches():
+    """
+    tests that iter_batches streams the result in chunks of at most batch_size rows, with dates as datetimes
+    """
+    query = Query(query="select * from '{{table}}';",table=full_path_test_data_file())
+    sizes = []
+    for df in query.iter_batches(batch_size=100):
+        assert str(df['dates'].dtype).startswith('datetime64')
+        sizes.append(len(df))
+    assert max(sizes)<=100
+    assert sum(sizes)==len(pd.read_csv(full_path_test_data_file()))
+    assert query.df is None
+
+def test_iter_batches_writes_cache():
+    """
+    tests that iter_batches writes the streamed batches into the cache as it goes
+    """
+    set_temp_workspace()
+    query = Query(query="select * from '{{table}}';",table=full_path_test_data_file())
+    n_rows = sum(len(df) for df in query.iter_batches(batch_size=100, cache=True))
+    assert query.csv==os.path.join(dqt.cache_dir(query.get_cache_key()), 'data.parquet')
+    df_cached = dqt.read_cache_data(query.csv)
+    assert len(df_cached)==n_rows
+    assert str(df_cached['dates'].dtype).startswith('datetime64')
+    assert not [f for f in os.listdir(os.path.dirname(query.csv)) if f.endswith('.tmp')]
+    assert dqt.get_cache_index().get(query.get_cache_key())['rows']==n_rows
+
+def test_iter_batches_keeps_types_when_batch_values_change(monkeypatch):
+    """
+    tests that batches whose arrow types depend on their values (as snowflake's do) all come out, and are cached,
+    with the types chosen from the first batch's schema
+    """
+    import datetime
+    set_temp_workspace()
+    batches = [
+        pa.table({'n': pa.array([1, 2], type=pa.int8()), 'd': pa.array([datetime.date(2023, 1, 1)]*2)}),
+        pa.table({'n': pa.array([2**40], type=pa.int64()), 'd': pa.array([datetime.date(2023, 1, 2)])}),
+    ]
+    monkeypatch.setattr(Query, '_iter_arrow_batches', lambda self, batch_size, database, schema: iter(batches))
+    query = Query(query="select 1 as n, current_date as d;")
+    dfs = list(query.iter_batches(cache=True))
+    assert [str(df['n'].dtype) for df in dfs]==['int64', 'int64']
+    assert all(str(df['d'].dtype)=='datetime64[ns]' for df in dfs)
+    df_cached = dqt.read_cache_data(query.csv)
+    assert df_cached['n'].tolist()==[1, 2, 2**40]
+
+    with dqt.CacheWriter(os.path.dirname(query.csv), fmt='feather') as writer:
+        writer.write(pa.table({'n': pa.array([1], type=pa.int16())}))
+        writer.write(pa.table({'n': pa.array([3], type=pa.int8())}))
+    assert dqt.read_cache_data(writer.filename)['n'].tolist()==[1, 3]
+
+def test_fetch_arrow_maps_snowflake_types():
+    """
+    tests that arrow results from snowflake have DATE and NUMBER columns mapped to datetime64/int64/float64
+    """
+    import datetime
+    import decimal
+    import pyarrow as pa
+
+    class FakeCursor:
+        description = [('D',), ('N',), ('X',)]
+        def execute(self, sql):
+            self.sql = sql
+        def fetch_arrow_all(self):
+            return pa.table({
+                'D': pa.array([datetime.date(2023, 1, 31)], type=pa.date32()),
+                'N': pa.array([decimal.Decimal(12)], type=pa.decimal128(38, 0)),
+                'X': pa.array([decimal.Decimal('1.25')], type=pa.decimal128(38, 2)),
+            })
+        def close(self):
+            pass
+
+    class FakeConnection:
+        def cursor(self):
+            return FakeCursor()
+
+    df = dqt.fetch_arrow(FakeConnection(), 'select 1').to_pandas()
+    assert str(df['D'].dtype)=='datetime64[ns]'
+    assert str(df['N'].dtype)=='int64'
+    assert str(df['X'].dtype)=='float64'
+    assert df['X'][0]==1.25
+
+def test_run_many():
+    """
+    tests that run_many runs queries concurrently, runs identical sql once and collects errors per query
+    """
+    table = full_path_test_data_file()
+    queries = [
+        Query(query="select * from '{{table}}' where region='{{region}}';", table=table, region=region)
+        for region in ['US', 'GB', 'DE', 'US']
+    ]
+    queries.append(Query(query="select * from '{{table}}' where region='NZ';", table=table))
+    batch = dqt.run_many(queries, max_workers=4, max_per_warehouse={'duckdb': 2})
+    assert list(batch.errors)==[4]
+    assert isinstance(batch.errors[4], dqt.NoDataException)
+    assert batch.results[4] is None
+    assert set(batch.results[1]['region'])=={'GB'}
+    assert batch.results[0] is batch.results[3]
+
+def test_run_many_writes_a_shared_result_to_the_cache_once(monkeypatch):
+    """
+    tests that queries with identical sql in a batch share one cache write
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_batch.sql'), 'w') as f:
+        f.write("select {{n}} as n")
+    writes = []
+    write_cache = Query.write_cache
+    def spy(self, df, *args, **kwargs):
+        writes.append(self.get_cache_key())
+        return write_cache(self, df, *args, **kwargs)
+    monkeypatch.setattr(Query, 'write_cache', spy)
+
+    queries = [Query('delme_batch.sql', engine='duckdb', n=n) for n in [1, 1, 1, 2]]
+    batch = dqt.run_many(queries, refresh=True)
+    assert not batch.errors and sorted(writes)==sorted({q.get_cache_key() for q in queries})
+    assert queries[0].csv==queries[1].csv==queries[2].csv and os.path.exists(queries[1].csv)
+    assert batch.results[2]['n'].tolist()==[1]
+
+def test_cache_key_is_content_addressed():
+    """
+    tests that cache keys depend on the normalized sql and database context, not on formatting
+    """
+    key = dqt.cache_key("select a,  b\nfrom t where c = 'x  y';", database='DB', schema='S')
+    assert key==dqt.cache_key("select a, b from t where c = 'x  y'", database='DB', schema='S')
+    assert key!=dqt.cache_key("select a, b from t where c = 'x y'", database='DB', schema='S')
+    assert key!=dqt.cache_key("select a, b from t where c = 'x  y'", database='DB', schema='OTHER')
+
+def test_cache_key_keeps_the_end_of_line_comments():
+    """
+    tests that normalizing whitespace doesn't fold the sql after a -- comment into the comment
+    """
+    commented = "select 1 as a -- note\n, 2 as b"
+    assert dqt.cache_key(commented)!=dqt.cache_key("select 1 as a -- note , 2 as b")
+    assert dqt.cache_key(commented)==dqt.cache_key("select 1 as a   -- note  \n\n   , 2 as b;")
+    assert list(dqt.Workspace().sql(dqt.normalize_sql(commented)).columns)==['a', 'b']
+    assert dqt.cache_key("select /* a  b */ 1")!=dqt.cache_key("select /* a b */ 1")
+
+def test_legacy_cache_lookup_tolerates_non_string_params():
+    """
+    tests that queries with list, bool, date and None params can be built (the legacy cache folder lookup used to
+    fail on them) and that legacy folders named after string params are still found
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_params.sql'), 'w') as f:
+        f.write("select {{ ids | join(', ') }} as ids, {{ flag }} as flag, '{{ day }}' as day, '{{ other }}' as other")
+    query = Query('delme_params.sql', ids=[1, 2, 3], flag=True, day=pd.Timestamp('2023-01-01').date(), other=None)
+    assert not query.is_cached()
+
+    legacy = dqt.legacy_cache_dir('delme_params.sql', ids=['a', 'b'], flag='x', day='d', other='o')
+    assert os.path.basename(legacy)=='delme_params__ids__a|b__flag__x__day__d__other__o'
+    os.makedirs(legacy)
+    pd.DataFrame({'n': [1]}).to_parquet(os.path.join(legacy, 'data.parquet'))
+    assert Query('delme_params.sql', ids=['a', 'b'], flag='x', day='d', other='o').is_cached()
+
+def test_cache_is_shared_across_templates_with_same_sql():
+    """
+    tests that a cached result is found via the manifest by any template compiling to the same sql
+    """
+    set_temp_workspace()
+    for name in ['delme_a.sql', 'delme_b.sql']:
+        with open(os.path.join(get_user_template_dir(), name), 'w') as f:
+            f.write("select {{n}} as n")
+    query = Query('delme_a.sql', n=1)
+    assert query.cache and not query.is_cached()
+    df = pd.DataFrame({'n': [1]})
+    query.write_cache(df)
+
+    other = Query('delme_b.sql', n=1)
+    assert other.is_cached() and other.cache_is_synced()
+    pd.testing.assert_frame_equal(other.load(), df)
+    entry = dqt.get_cache_index().get(other.get_cache_key())
+    assert entry['rows']==1 and entry['template']=='delme_a.sql'
+    assert not Query('delme_b.sql', n=2).is_cached()
+
+def test_prune_cache_and_cache_stats():
+    """
+    tests eviction of least recently used and expired cache entries, and the workspace cache stats
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_prune.sql'), 'w') as f:
+        f.write("select {{n}} as n")
+    queries = [Query('delme_prune.sql', n=n) for n in range(3)]
+    for query in queries:
+        query.write_cache(pd.DataFrame({'n': [query.params.n]}))
+    queries[0].load()  # queries[0] is now the most recently used
+
+    workspace = dqt.Workspace()
+    stats = workspace.cache_stats()
+    assert stats['entries']==3 and stats['session_hits']>=1
+    assert stats['by_entry']['key'][0]==queries[0].get_cache_key()
+
+    evicted = workspace.prune_cache(max_entries=2)
+    assert evicted==[queries[1].get_cache_key()]
+    assert not queries[1].is_cached()
+    assert not os.path.exists(dqt.cache_dir(queries[1].get_cache_key()))
+
+    dqt.set_cache_policy(template_ttl={'delme_prune.sql': 0})
+    try:
+        assert not queries[0].is_cached()
+        assert len(workspace.prune_cache())==2
+    finally:
+        dqt.set_cache_policy()
+
+def test_prune_cache_sweeps_folders_missing_from_the_manifest():
+    """
+    tests that legacy (template named) cache folders and orphaned key folders are reported by cache_stats and
+    evicted by prune_cache, while folders which may still be being written are left alone
+    """
+    set_temp_workspace()
+    root = dqt.cache_root()
+    old = time.time() - 2*dqt.UNINDEXED_GRACE_SECONDS
+    folders = {'legacy': 'delme_legacy__n__1', 'orphan': 'ab'*16, 'fresh': 'cd'*16}
+    for kind, name in folders.items():
+        os.makedirs(os.path.join(root, name))
+        pd.DataFrame({'n': range(1000)}).to_parquet(os.path.join(root, name, 'data.parquet'))
+        if kind!='fresh':
+            for f in [os.path.join(root, name, 'data.parquet'), os.path.join(root, name)]:
+                os.utime(f, (old, old))
+
+    workspace = dqt.Workspace()
+    stats = workspace.cache_stats()
+    assert stats['unindexed']==3 and stats['bytes']>0
+    assert set(stats['by_entry']['key'])==set(folders.values())
+
+    # the orphan always goes; the legacy folder goes by the policy, like any other entry
+    assert workspace.prune_cache(max_entries=1)==[folders['orphan']]
+    assert workspace.prune_cache(max_entries=0)==[folders['legacy']]
+    assert set(os.listdir(root)) - {dqt.CACHE_INDEX_FILE}=={folders['fresh']}
+
+def test_memory_cache_serves_repeat_loads():
+    """
+    tests that with a memory budget, repeat loads are served from memory and re-runs/evictions invalidate it
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_memory.sql'), 'w') as f:
+        f.write("select {{n}} as n")
+    dqt.set_memory_cache(10**6)
+    try:
+        query = Query('delme_memory.sql', n=1)
+        query.write_cache(pd.DataFrame({'n': [1]}))
+        os.remove(query.get_cache_files()[0])  # so only the memory tier can serve it
+        df = Query('delme_memory.sql', n=1).load()
+        assert list(df['n'])==[1]
+        assert dqt.MEMORY_CACHE.stats()['hits']>=1
+
+        query.write_cache(pd.DataFrame({'n': [2]}))
+        assert list(Query('delme_memory.sql', n=1).load()['n'])==[2]
+
+        dqt.Workspace().prune_cache(max_entries=0)
+        assert dqt.MEMORY_CACHE.get((dqt.cache_root(), query.get_cache_key())) is None
+    finally:
+        dqt.set_memory_cache(0)
+        dqt.MEMORY_CACHE.clear()
+
+def test_cached_results_are_views_in_workspace_duckdb():
+    """
+    tests that cached results are registered as views in the workspace duckdb database (when it is opened) and can
+    be queried locally
+    """
+    set_temp_workspace()
+    dqt.close_duckdb()
+    with open(os.path.join(get_user_template_dir(), 'delme_views.sql'), 'w') as f:
+        f.write("select * from sales where region='{{region}}'")
+    for region, gmv in [('US', 10.0), ('GB', 5.0)]:
+        Query('delme_views.sql', region=region).write_cache(pd.DataFrame({'region': [region], 'gmv': [gmv]}))
+    # caching a result doesn't open (and lock) the workspace database; its views are registered when it's opened
+    assert dqt._DUCKDB_CONNECTIONS=={}
+    us, gb = Query('delme_views.sql', region='US'), Query('delme_views.sql', region='GB')
+    assert us.view_name.startswith('cache.delme_views_')
+
+    union = f"select * from {us.view_name} union all select * from {gb.view_name}"
+    assert dqt.Workspace().sql(f"select sum(gmv) as gmv from ({union})")['gmv'][0]==15.0
+    assert Query(query=f"select region from ({union}) order by region", engine='duckdb').run()['region'].tolist()==['GB', 'US']
+
+    # views persist in the workspace database file
+    dqt.close_duckdb()
+    assert len(dqt.Workspace().sql(f"select * from {us.view_name}"))==1
+
+    dqt.Workspace().prune_cache(max_entries=0)
+    views = dqt.Workspace().sql("select table_name from information_schema.tables where table_schema='cache'")
+    assert len(views)==0
+
+def test_feather_caches_are_attached_without_copying_into_duckdb():
+    """
+    tests that feather caches aren't copied into the workspace duckdb database but can still be queried locally
+    """
+    dqt.close_duckdb()
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_feather.sql'), 'w') as f:
+        f.write("select * from sales where region='{{region}}'")
+    query = Query('delme_feather.sql', cache_format='feather', region='US')
+    size = os.path.getsize(dqt.get_duckdb_file()) if os.path.exists(dqt.get_duckdb_file()) else 0
+    query.write_cache(pd.DataFrame({'region': ['US']*100000, 'gmv': np.arange(100000.0)}))
+    dqt.get_duckdb().execute('CHECKPOINT')
+    assert os.path.getsize(dqt.get_duckdb_file()) - size < 1024**2
+    tables = dqt.Workspace().sql("select table_name from information_schema.tables where table_schema='cache'")
+    assert len(tables)==0
+
+    assert dqt.Workspace().sql(f"select sum(gmv) as gmv from {query.view_name}")['gmv'][0]==np.arange(100000.0).sum()
+    df = Query(query=f"select count(*) as n from {query.view_name} where gmv < 10", engine='duckdb').run()
+    assert df['n'].tolist()==[10]
+
+def test_csv_ingest_converts_local_csv_once():
+    """
+    tests that with csv ingest on, a local csv is converted to parquet once and queries on it give the same results
+    """
+    set_temp_workspace()
+    sql = "select * from '{{table}}'"
+    expected = Query(sql, table=full_path_test_data_file()).run()
+    dqt.set_csv_ingest(True)
+    try:
+        query = Query(sql, table=full_path_test_data_file())
+        assert 'read_parquet(' in query.sql.text and query.engine=='duckdb' and not query.cache
+        pd.testing.assert_frame_equal(query.run(), expected)
+        ingested = os.listdir(dqt.get_ingest_dir())
+        assert len(ingested)==1
+        mtime = os.path.getmtime(os.path.join(dqt.get_ingest_dir(), ingested[0]))
+        Query(sql, table=full_path_test_data_file()).run()
+        assert os.listdir(dqt.get_ingest_dir())==ingested
+        assert os.path.getmtime(os.path.join(dqt.get_ingest_dir(), ingested[0]))==mtime
+    finally:
+        dqt.set_csv_ingest(False)
+
+def test_json_data_tests():
+    """
+    tests the json data test engine on the README example: counts and failing indices by default, records on request
+    """
+    set_temp_workspace()
+    query = Query(query="select * from '{{table}}';", table=full_path_test_data_file())
+    query.run()
+    query.df['gmv_per_order'] = query.df['gmv']/query.df['orders']
+    query.df['wgts'] = query.df['gmv']/query.df['gmv'].sum()
+    query.df.loc[0, ['gmv', 'gmv_per_order']] = np.nan
+    tests = [
+        {"name": "gmv_per_order_check", "assert": "'gmv_per_order'=='gmv'/'orders'"},
+        {"name": "orders_are_non_negative", "assert": "'orders'>=0"},
+        {"name": "orders_come_from_css", "assert": "'source'==`css`"},
+        {"name": "wgts_sum_to_one", "assert": "'wgts'.sum()==1"},
+        {"name": "wgts_sum_to_one_within_epsilon", "assert": "('wgts'.sum()>0.9999) & ('wgts'.sum()<=1.0001)"},
+    ]
+    ws_root, ws_name = dqt.get_ws()
+    with open(os.path.join(ws_root, ws_name, 'tests/json/example.json'), 'w') as f:
+        json.dump({"tests": tests}, f)
+
+    report = query.test('example', verbose=False)
+    assert query.tests['example'] is report
+    assert report['gmv_per_order_check']=='All Passed!' and report['orders_are_non_negative']=='All Passed!'
+    assert report['wgts_sum_to_one_within_epsilon']=='Passed'
+    not_css = query.df.index[query.df['source']!='css']
+    fails = report['orders_come_from_css']
+    assert fails['fails']==len(not_css) and (fails['failed_index']==not_css).all()
+    assert 'failed_records' not in fails
+
+    report = query.test('example', failed_records=True, verbose=False)
+    pd.testing.assert_frame_equal(report['orders_come_from_css']['failed_records'], query.df.loc[not_css])
+
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, sql):
+        self.conn.statements.append(sql)
+        if sql.startswith('DESCRIBE TABLE'):
+            self.rows = [(c, 'VARCHAR', 'COLUMN') for c in self.conn.columns]
+        elif sql.startswith('PUT'):
+            stage_dir = sql.split("'")[1][len('file://'):-len('/*.parquet')]
+            self.conn.staged = pd.concat([pd.read_parquet(os.path.join(stage_dir, f)) for f in sorted(os.listdir(stage_dir))])
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+class RecordingConnection:
+    def __init__(self, columns):
+        self.columns = columns
+        self.statements = []
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+def test_stage_to_snowflake_uses_staged_parquet_and_merge():
+    """
+    tests that appends are staged as parquet chunks and loaded server-side, with a MERGE when unique is given
+    """
+    df = pd.read_csv(full_path_test_data_file())
+    conn = RecordingConnection(columns=[c.upper() for c in df.columns])
+    batches = pa.Table.from_pandas(df, preserve_index=False).to_batches(max_chunksize=100)
+    assert dqt.stage_to_snowflake(conn, 'DELME', batches, unique='source', parallel=8)==len(df)
+
+    assert len(conn.staged)==len(df)
+    assert (conn.staged['DQT_ROW_NUMBER'].to_numpy()==np.arange(len(df))).all()
+    assert (conn.staged['C4'].to_numpy()==df['source'].to_numpy()).all()
+    put = [sql for sql in conn.statements if sql.startswith('PUT')][0]
+    assert 'PARALLEL=8' in put
+    assert any('MERGE INTO DELME' in sql and 'ON t."SOURCE" = s."SOURCE"' in sql for sql in conn.statements)
+    assert not any('VALUES (' in sql and 'MERGE' not in sql for sql in conn.statements)
+
+    conn = RecordingConnection(columns=[c.upper() for c in df.columns])
+    dqt.stage_to_snowflake(conn, 'DELME', batches)
+    assert any(sql.startswith('INSERT INTO DELME') for sql in conn.statements)
+    assert not any('MERGE' in sql for sql in conn.statements)
+
+def test_stage_to_snowflake_drops_temp_table_when_a_load_fails():
+    """
+    tests that the temporary staging table is dropped even if the COPY fails, as pooled sessions are reused
+    """
+    class FailingCursor(RecordingCursor):
+        def execute(self, sql):
+            super().execute(sql)
+            if sql.startswith('COPY INTO'):
+                raise Exception('copy failed')
+            return self
+
+    conn = RecordingConnection(columns=['N'])
+    conn.cursor = lambda: FailingCursor(conn)
+    with pytest.raises(Exception, match='copy failed'):
+        dqt.stage_to_snowflake(conn, 'DELME', pa.table({'n': [1, 2]}).to_batches())
+    temp_table = [sql.split()[3] for sql in conn.statements if sql.startswith('CREATE TEMPORARY TABLE')][0]
+    assert conn.statements[-1]==f'DROP TABLE IF EXISTS {temp_table}'
+
+def test_run_sets_date_dtypes_from_schema_and_write_sql_leaves_df_alone(monkeypatch):
+    """
+    tests that date columns become datetimes from the result schema (even with a leading null) and that write_sql
+    writes them as dates without changing query.df
+    """
+    query = Query("select * from (values (null, 1), (date '2022-01-31', 2)) t(d, n)", engine='duckdb')
+    df = query.run()
+    assert str(df['d'].dtype)=='datetime64[ns]' and df['d'].isna()[0]
+
+    conn = RecordingConnection(columns=['D', 'N'])
+    monkeypatch.setattr(dqt, 'get_connection', lambda **kwargs: contextlib.nullcontext(conn))
+    query.write_sql('DELME', append=True, write_timestamp=False)
+    pd.testing.assert_frame_equal(query.df, df)
+    assert conn.staged['C0'].tolist()[1]==pd.Timestamp('2022-01-31').date()
+
+def test_sql_is_run_as_rendered_and_formatted_lazily():
+    """
+    tests that Sql keeps the rendered sql, only formats it for display, and leaves the compiled dir alone
+    """
+    set_temp_workspace()
+    compiled_file = os.path.join(dqt.temp_sql_compiled_template_dir(), 'keep.sql')
+    Path(compiled_file).touch()
+    sql = dqt.Sql("select a,\n  b from t where c = 'x'")
+    assert sql.text=="select a,\n  b from t where c = 'x'"
+    assert 'formatted' not in sql.__dict__ and os.path.exists(compiled_file)
+    assert repr(sql).startswith('SELECT a,')
+    assert sql.fingerprint==dqt.Sql("select a, b from t where c = 'x';").fingerprint
+    assert dqt.cache_key(sql, database='DB', schema='S')==dqt.cache_key(sql.text, database='DB', schema='S')
+
+def test_test_suite_runs_sql_tests_concurrently():
+    """
+    tests that TestSuite discovers test_*.sql templates, reports pass / fail / error with timings and only fetches
+    failing records on request
+    """
+    set_temp_workspace()
+    tests = {
+        'test_orders_non_negative.sql': "select * from '{{table}}' where orders < 0",
+        'test_only_css.sql': "select * from '{{table}}' where source != 'css'",
+        'test_broken.sql': "select * from '{{table}}' where no_such_column > 0",
+    }
+    for name, sql in tests.items():
+        with open(os.path.join(dqt.get_user_tests_template_dir(), name), 'w') as f:
+            f.write(sql)
+
+    suite = dqt.TestSuite(mode='count', table=full_path_test_data_file()).run()
+    results = {r['name']: r for r in suite.report['tests']}
+    assert sorted(results)==sorted(tests)
+    assert results['test_orders_non_negative.sql']['result']=='PASSED'
+    assert results['test_only_css.sql']['result']=='FAILED' and results['test_only_css.sql']['fails']==378
+    assert results['test_broken.sql']['result']=='ERROR' and results['test_broken.sql']['error']
+    assert (suite.report['passed'], suite.report['failed'], suite.report['errors'])==(1, 1, 1)
+    assert suite.failed_records=={} and json.loads(suite.to_json())==suite.report
+
+    suite = dqt.TestSuite(tests=['test_only_css.sql'], details=True, table=full_path_test_data_file()).run()
+    assert len(suite.failed_records['test_only_css.sql'])==378
+
+def test_incremental_load_fetches_only_new_rows(monkeypatch):
+    """
+    tests that load(incremental_on=...) appends rows past the cached watermark, and re-fetches a lookback window
+    """
+    set_temp_workspace()
+    con = dqt.get_duckdb()
+    con.execute("create or replace table main.delme_facts as select * from (values (date '2023-01-01', 1), (date '2023-01-02', 2)) t(d, n)")
+    with open(os.path.join(get_user_template_dir(), 'delme_facts.sql'), 'w') as f:
+        f.write("select * from main.delme_facts")
+    query = Query('delme_facts.sql', engine='duckdb')
+    assert len(query.load(incremental_on='d'))==2
+    assert dqt.get_cache_index().get(query.get_cache_key())['watermark']=={'d': '2023-01-02T00:00:00'}
+
+    con.execute("insert into main.delme_facts values (date '2023-01-03', 3)")
+    fetched = []
+    fetch_arrow = Query._fetch_arrow
+    def spy(self, sql, **kwargs):
+        table = fetch_arrow(self, sql, **kwargs)
+        fetched.append(table.num_rows)
+        return table
+    monkeypatch.setattr(Query, '_fetch_arrow', spy)
+    query = Query('delme_facts.sql', engine='duckdb')
+    df = query.load(incremental_on='d')
+    assert fetched==[1] and df['n'].tolist()==[1, 2, 3]
+    assert Query('delme_facts.sql', engine='duckdb').load()['n'].tolist()==[1, 2, 3]
+    assert dqt.get_cache_index().get(query.get_cache_key())['watermark']=={'d': '2023-01-03T00:00:00'}
+
+    con.execute("update main.delme_facts set n = 30 where n = 3")
+    df = Query('delme_facts.sql', engine='duckdb').load(incremental_on='d', lookback=pd.Timedelta(days=1))
+    assert fetched==[1, 2] and df['n'].tolist()==[1, 2, 30]
+    con.execute("drop table main.delme_facts")
+
+def test_partitioned_cache_fetches_missing_partitions_and_prunes(monkeypatch):
+    """
+    tests that load_partitions stores results as a hive partitioned dataset, only runs missing partitions and reads
+    back just the requested ones
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_region.sql'), 'w') as f:
+        f.write("select source, region, sum(orders) as orders from '{{table}}' where region = '{{region}}' group by 1, 2")
+    ran = []
+    run = Query.run
+    def spy(self, *args, **kwargs):
+        ran.append(self.params.region)
+        return run(self, *args, **kwargs)
+    monkeypatch.setattr(Query, 'run', spy)
+
+    query = Query('delme_region.sql', partition_by='region', table=full_path_test_data_file())
+    df = query.load_partitions(region=['US', 'GB'])
+    assert sorted(ran)==['GB', 'US'] and sorted(df['region'].unique())==['GB', 'US'] and len(df)==8
+    assert os.path.exists(os.path.join(query.partition_root, 'region=US', 'data.parquet'))
+
+    df = query.load_partitions(region=['US', 'DE'])
+    assert sorted(ran)==['DE', 'GB', 'US'] and sorted(df['region'].unique())==['DE', 'US']
+    assert query.partitions()==[{'region': 'DE'}, {'region': 'GB'}, {'region': 'US'}]
+    assert len(query.load_partitions())==12 and len(ran)==3
+
+def test_partitions_are_in_a_manifest_and_subject_to_the_cache_policy(monkeypatch):
+    """
+    tests that partitions (including empty ones, which aren't re-run) are recorded in the partition manifest,
+    reported by cache_stats and evicted by prune_cache
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_region.sql'), 'w') as f:
+        f.write("select source, region, sum(orders) as orders from '{{table}}' where region = '{{region}}' group by 1, 2")
+    ran = []
+    run = Query.run
+    def spy(self, *args, **kwargs):
+        ran.append(self.params.region)
+        return run(self, *args, **kwargs)
+    monkeypatch.setattr(Query, 'run', spy)
+
+    query = Query('delme_region.sql', partition_by='region', table=full_path_test_data_file())
+    assert len(query.load_partitions(region=['US', 'NZ']))==4
+    assert len(query.load_partitions(region=['US', 'NZ']))==4 and sorted(ran)==['NZ', 'US']
+    entries = dqt.get_cache_index(dqt.partition_cache_root()).entries()
+    assert sorted(entry['rows'] for entry in entries.values())==[0, 4]
+    assert len(query.load_partitions(region=['NZ']))==0 and len(ran)==2
+
+    workspace = dqt.Workspace()
+    stats = workspace.cache_stats()
+    assert stats['partitions']==2 and stats['unindexed']==0
+    assert len(workspace.prune_cache(template_ttl={'delme_region.sql': 0}))==2
+    assert dqt.get_cache_index(dqt.partition_cache_root()).entries()=={}
+    assert not os.path.exists(os.path.join(query.partition_root, 'region=US'))
+    with pytest.raises(dqt.NoDataException):
+        query.load_partitions()
+    with pytest.raises(dqt.NoDataException):
+        query.load_partitions(region=['NZ'])
+
+def test_sweep_runs_grid_once_per_distinct_sql(monkeypatch):
+    """
+    tests that Query.sweep concatenates results over a param grid with param columns, running identical sql once
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_sweep.sql'), 'w') as f:
+        f.write("select count(*) as n from '{{table}}' where region = '{{region}}'{% if source != 'any' %} and source = '{{source}}'{% endif %}")
+    ran = []
+    run = Query.run
+    def spy(self, *args, **kwargs):
+        ran.append(self.sql.text)
+        return run(self, *args, **kwargs)
+    monkeypatch.setattr(Query, 'run', spy)
+
+    grid = {'region': ['US', 'GB', 'US'], 'source': ['css', 'any']}
+    df = Query.sweep('delme_sweep.sql', grid=grid, table=full_path_test_data_file())
+    assert len(df)==6 and len(ran)==4
+    assert list(df.columns)==['n', 'region', 'source']
+    assert df.loc[(df['region']=='GB') & (df['source']=='any'), 'n'].tolist()==[84]
+    assert df.loc[df['source']=='css', 'n'].tolist()==[21, 21, 21]
+    table = Query.sweep('delme_sweep.sql', grid={'region': ['US']}, as_arrow=True, table=full_path_test_data_file(), source='any')
+    assert isinstance(table, pa.Table) and table.column_names==['n', 'region']
+
+def test_grouping_sets_macro_aggregates_all_combinations_in_one_query():
+    """
+    tests the grouping_sets / grouping_id macros against one group by per combination of dims
+    """
+    dims = ['region', 'source']
+    query = Query(
+        query="select {{ macros.grouping_id(dims) }}, region, source, sum(orders) as orders from '{{table}}' {{ macros.grouping_sets(dims) }}",
+        table=full_path_test_data_file(), dims=dims,
+    )
+    assert query.sql.text.count('GROUPING SETS')==1
+    frames = dqt.split_grouping_sets(query.run(), dims)
+    assert list(frames)==[('region',), ('source',), ('region', 'source')]
+    data = pd.read_csv(full_path_test_data_file())
+    for grouped_by, frame in frames.items():
+        expected = data.groupby(list(grouped_by), as_index=False)['orders'].sum()
+        frame = frame.sort_values(list(grouped_by)).reset_index(drop=True)
+        assert list(frame.columns)==list(grouped_by) + ['orders']
+        assert frame['orders'].astype('int64').tolist()==expected['orders'].tolist()
+
+def test_query_profile_stats_and_hooks():
+    """
+    tests that run() and load() record stage timings, rows and bytes in Query.profile, feed the process-wide stats
+    and call profile hooks
+    """
+    set_temp_workspace()
+    with open(os.path.join(get_user_template_dir(), 'delme_profile.sql'), 'w') as f:
+        f.write("select {{n}} as n")
+    profiles = []
+    dqt.add_profile_hook(profiles.append)
+    try:
+        query = Query('delme_profile.sql', engine='duckdb', n=1)
+        query.load()
+        assert {'compile', 'execute', 'fetch', 'convert', 'cache_write', 'total'} <= set(query.profile.stages)
+        assert query.profile.cache=='miss' and query.profile.rows==1 and query.profile.bytes['cache_write']>0
+        Query('delme_profile.sql', engine='duckdb', n=1).load()
+    finally:
+        dqt.remove_profile_hook(profiles.append)
+    assert [p['call'] for p in profiles]==['load', 'load'] and profiles[1]['cache']=='hit'
+    assert 'cache_read' in profiles[1]['stages'] and 'execute' not in profiles[1]['stages']
+    stats = dqt.get_query_stats()['delme_profile.sql']
+    assert stats['cache_hits']>=1 and stats['cache_misses']>=1 and 0<stats['p50']<=stats['p95']
+
+def test_generate_data_is_seeded_chunked_and_writes_each_format(tmp_path):
+    """
+    tests that generate_data gives the same data for a seed whatever the output format, with the requested dims and
+    date span, and that grid=True enumerates every combination like test.csv
+    """
+    df = dqt.generate_data(2500, dims=2, cardinality=[3, 7], start='2023-01-01', periods=10, seed=7, chunk_size=1000)
+    assert list(df.columns)==['dates', 'orders', 'gmv', 'dim_1', 'dim_2'] and len(df)==2500
+    assert df['dim_1'].nunique()==3 and df['dim_2'].nunique()==7
+    assert df['dates'].min()>=pd.Timestamp('2023-01-01') and df['dates'].max()<=pd.Timestamp('2023-01-10')
+    assert not df.equals(dqt.generate_data(2500, dims=2, cardinality=[3, 7], start='2023-01-01', periods=10, seed=8, chunk_size=1000))
+
+    kwargs = dict(dims=2, cardinality=[3, 7], start='2023-01-01', periods=10, seed=7, chunk_size=1000)
+    parquet = dqt.read_cache_data(dqt.generate_data(2500, str(tmp_path / 'data.parquet'), **kwargs))
+    csv = pd.read_csv(dqt.generate_data(2500, str(tmp_path / 'data.csv'), **kwargs), parse_dates=['dates'])
+    import duckdb
+    dqt.generate_data(2500, str(tmp_path / 'data.duckdb'), table='orders', **kwargs)
+    with duckdb.connect(str(tmp_path / 'data.duckdb')) as con:
+        table = con.execute('select * from orders').df()
+    for other in [parquet, csv, table]:
+        assert np.allclose(other['gmv'], df['gmv']) and (other['dim_2']==df['dim_2']).all()
+        assert (pd.to_datetime(other['dates'])==df['dates']).all()
+
+    grid = dqt.generate_data(504, dims={'region': 6, 'source': 4}, periods=21, grid=True)
+    assert len(grid.drop_duplicates(['dates', 'region', 'source']))==504
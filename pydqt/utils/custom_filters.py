@@ -6,4 +6,13 @@ def dqt_combinations(iterable):
     result = []
     for k in range(1, len(iterable) + 1):
         result.append(list(combinations(iterable, k)))
-    return result
\ No newline at end of file
+    return result
+
+def dqt_grouping_sets(iterable, min_size=1, max_size=None):
+    """
+    returns a GROUPING SETS clause over every combination of the columns in iterable (the same combinations as
+    dqt_combinations), so that all of them can be aggregated in one query.  min_size=0 adds the grand total.
+    """
+    max_size = len(iterable) if max_size is None else max_size
+    sets = [c for k in range(min_size, max_size + 1) for c in combinations(iterable, k)]
+    return 'GROUPING SETS (' + ', '.join('(' + ', '.join(s) + ')' for s in sets) + ')'